@@ -0,0 +1,55 @@
+'''
+Unified entry point for cfss scripts. Usage: `python cfss <command> [args...]` or `python -m cfss <command> [args...]`
+
+Modules are imported only when their command is invoked so that light commands start fast.
+'''
+import sys
+from pathlib import Path
+
+
+# command: (module, description)
+COMMANDS = {
+    'zip2mha': ('zip2mha', 'Convert (zipped) dicom into mha files'),
+    'remove_bed': ('remove_bed', 'Remove bed from CT images in a directory'),
+    'segment_bone': ('segment_bone', 'Segment bone'),
+    'fast_marching': ('fast_marching', 'Fast marching (level set)'),
+    'create_mesh': ('create_mesh', 'Create mesh from segmentation'),
+    'add_point_normals': ('add_point_normals', 'Calculate point normals from polygon data'),
+    'align_meshes': ('align_meshes', 'Align bounding boxes of meshes'),
+    'align_landmarks': ('align_landmarks', 'Align two meshes using landmark points'),
+    'landmark': ('landmark', 'Create camera presets'),
+    'show_landmarks': ('show_landmarks', 'Show landmark points on mesh'),
+    'shape_stats': ('shape_stats', 'Open shape statistics browser'),
+    'ssm': ('ssm', 'Build statistical shape model data'),
+    'zscore_report': ('zscore_report', 'Write distances and z-scores between landmark pairs for all subjects'),
+    'utils': ('utils', 'CFDB utilities'),
+}
+
+
+def print_help():
+    print('usage: cfss <command> [args...]\n\ncommands:')
+    for name, (_, description) in COMMANDS.items():
+        print(f'  {name:<20}{description}')
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] in ['-h', '--help']:
+        print_help()
+        return 0
+    command = sys.argv[1]
+    if command not in COMMANDS:
+        print(f'Unknown command: {command}\n')
+        print_help()
+        return 1
+
+    # scripts import each other as top level modules
+    sys.path.insert(0, str(Path(__file__).parent))
+    import importlib
+
+    module = importlib.import_module(COMMANDS[command][0])
+    sys.argv = [f'cfss {command}'] + sys.argv[2:]
+    return module.main()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
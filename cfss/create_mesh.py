@@ -1,38 +1,117 @@
 import argparse
+import hashlib
+import json
 import sys
+from pathlib import Path
+from typing import Optional
 
+import numpy as np
 import pyacvd
 import pyvista as pv
-from utils import calculate_normals, write_mesh
+from logzero import logger
+from utils import (
+    add_batch_arguments,
+    calculate_normals,
+    estimate_image_bytes,
+    file_hash,
+    read_batch,
+    run_parallel,
+    write_mesh,
+)
+from vtkmodules.util.numpy_support import vtk_to_numpy
+from vtkmodules.vtkCommonDataModel import vtkImageData
 from vtkmodules.vtkFiltersCore import vtkWindowedSincPolyDataFilter
 from vtkmodules.vtkFiltersGeneral import vtkDiscreteMarchingCubes
+from vtkmodules.vtkImagingCore import vtkExtractVOI
 from vtkmodules.vtkIOImage import vtkMetaImageReader, vtkNIFTIImageReader
 
 
-def main():
-    parser = argparse.ArgumentParser(description='Fast marching (level set).')
-    parser.add_argument('input', help='Input segmentation filename', metavar='<input>')
-    parser.add_argument('output', help='Output vtp/xml filename', metavar='<output>')
-    parser.add_argument('--points', help='Number of pints in the mesh. default: %(default)s', type=int, default=80000)
-    args = parser.parse_args()
+MEM_FACTOR = 64  # rough peak memory usage relative to the input segmentation (uint8)
+SMOOTHING_PARAMS = {
+    'vtk': {'iterations': 20, 'pass_band': 0.001, 'feature_angle': 45.0},
+    'numpy': {'iterations': 20, 'lamb': 0.5, 'mu': -0.53},
+}
+
 
-    if args.input.endswith('.nii.gz'):
+def load_image(filename: str) -> vtkImageData:
+    if filename.endswith('.nii.gz'):
         reader = vtkNIFTIImageReader()
     else:
         reader = vtkMetaImageReader()
-    reader.SetFileName(args.input)
+    reader.SetFileName(filename)
     reader.Update()
+    return reader.GetOutput()
+
+
+def crop_image(image: vtkImageData, margin: int = 1) -> vtkImageData:
+    '''
+    Crop image to the bounding box of the label (non-zero voxels) padded by `margin`.
+    Coordinates of voxels are kept.
+    '''
+    dims = image.GetDimensions()
+    arr = vtk_to_numpy(image.GetPointData().GetScalars()).reshape(dims[::-1])  # zyx
+    extent = []
+    for axis in [2, 1, 0]:  # xyz
+        nonzero = np.flatnonzero(np.any(arr, axis=tuple(a for a in range(3) if a != axis)))
+        offset = image.GetExtent()[2 * (2 - axis)]
+        extent += [max(nonzero[0] - margin, 0) + offset, min(nonzero[-1] + margin, arr.shape[axis] - 1) + offset]
+    voi = vtkExtractVOI()
+    voi.SetInputData(image)
+    voi.SetVOI(*[int(e) for e in extent])
+    voi.Update()
+    return voi.GetOutput()
+
+
+def extract_surface(image: vtkImageData):
+    '''
+    return: points (n x 3) and triangles (m x 3)
+    '''
     discrete = vtkDiscreteMarchingCubes()
-    discrete.SetInputData(reader.GetOutput())
+    discrete.SetInputData(image)
     discrete.SetValue(0, 1)
+    discrete.ComputeNormalsOff()
+    discrete.ComputeGradientsOff()
+    discrete.ComputeScalarsOff()
+    discrete.Update()
+    poly = discrete.GetOutput()
+    points = vtk_to_numpy(poly.GetPoints().GetData()).astype(np.float64)
+    faces = vtk_to_numpy(poly.GetPolys().GetConnectivityArray()).reshape(-1, 3)
+    return points, faces
+
 
-    smoothing_iterations = 20
-    pass_band = 0.001
-    feature_angle = 45.0
+def taubin_smooth(points: np.ndarray, faces: np.ndarray, iterations: int = 20, lamb: float = 0.5, mu: float = -0.53):
+    '''
+    Taubin (lambda/mu) smoothing with uniform Laplacian as sparse matrix
+    '''
+    from scipy import sparse
+
+    n = len(points)
+    edges = np.concatenate([faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]])
+    adj = sparse.coo_matrix((np.ones(len(edges)), (edges[:, 0], edges[:, 1])), shape=(n, n)).tocsr()
+    adj = adj + adj.T
+    adj.data[:] = 1  # remove duplicated edges
+    degree = np.asarray(adj.sum(axis=1)).ravel()
+    mean_op = sparse.diags(1 / np.maximum(degree, 1)) @ adj  # average of neighbors
+    points = points.copy()
+    for _ in range(iterations):
+        for factor in [lamb, mu]:
+            points += factor * (mean_op @ points - points)
+    return points
+
+
+def to_pyvista(points: np.ndarray, faces: np.ndarray) -> pv.PolyData:
+    cells = np.hstack([np.full((len(faces), 1), 3, dtype=faces.dtype), faces])
+    return pv.PolyData(points, cells.ravel())
+
+
+def smooth_vtk(image: vtkImageData, iterations: int = 20, pass_band: float = 0.001, feature_angle: float = 45.0):
+    discrete = vtkDiscreteMarchingCubes()
+    discrete.SetInputData(image)
+    discrete.SetValue(0, 1)
 
     smoother = vtkWindowedSincPolyDataFilter()
     smoother.SetInputConnection(discrete.GetOutputPort())
-    smoother.SetNumberOfIterations(smoothing_iterations)
+    smoother.SetNumberOfIterations(iterations)
     smoother.BoundarySmoothingOff()
     smoother.FeatureEdgeSmoothingOff()
     smoother.SetFeatureAngle(feature_angle)
@@ -40,17 +119,121 @@ def main():
     smoother.NonManifoldSmoothingOn()
     smoother.NormalizeCoordinatesOn()
     smoother.Update()
+    return smoother.GetOutput()
+
+
+def smooth_surface(input_filename: str, engine: str):
+    '''
+    Smoothed marching cubes surface
+    return: points (n x 3) and triangles (m x 3)
+    '''
+    image = load_image(input_filename)
+    params = SMOOTHING_PARAMS[engine]
+    if engine == 'numpy':
+        points, faces = extract_surface(crop_image(image))
+        return taubin_smooth(points, faces, **params), faces
+    else:
+        pv_mesh = pv.wrap(smooth_vtk(image, **params))
+        return pv_mesh.points, pv_mesh.faces.reshape(-1, 4)[:, 1:]
+
+
+def surface_key(input_filename: str, engine: str) -> str:
+    '''
+    Cache key of the smoothed surface: hash of the input and the smoothing parameters
+    '''
+    key = {'input': file_hash(input_filename), 'engine': engine, 'params': SMOOTHING_PARAMS[engine]}
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def create_mesh(
+    input_filename: str,
+    output_filename: str,
+    n_points: int,
+    engine: str = 'vtk',
+    cache_dir: Optional[str] = None,
+    warm_start: bool = False,
+):
+    '''
+    cache_dir: Directory to cache the smoothed surface and the cluster assignments.
+    warm_start: Reuse the cached cluster assignment for the same number of points instead of clustering.
+    '''
+    if engine not in SMOOTHING_PARAMS:
+        raise RuntimeError(f'Invalid engine: {engine}')
 
-    pv_mesh = pv.wrap(smoother.GetOutput())
-    clus = pyacvd.Clustering(pv_mesh)
-    # mesh is not dense enough for uniform remeshing
-    # clus.subdivide(3)
-    clus.cluster(args.points)
+    surface_fn = None
+    if cache_dir is not None:
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        key = surface_key(input_filename, engine)
+        surface_fn = Path(cache_dir) / f'{key}.npz'
+        clusters_fn = Path(cache_dir) / f'{key}_{n_points}.npy'
+
+    if surface_fn is not None and surface_fn.exists():
+        logger.debug('Load cached surface %s', surface_fn)
+        with np.load(surface_fn) as npz:
+            points, faces = npz['points'], npz['faces']
+    else:
+        points, faces = smooth_surface(input_filename, engine)
+        if surface_fn is not None:
+            tmp_fn = surface_fn.with_suffix('.part.npz')
+            np.savez(tmp_fn, points=points, faces=faces)
+            tmp_fn.replace(surface_fn)
+
+    clus = pyacvd.Clustering(to_pyvista(points, faces))
+    if warm_start and surface_fn is not None and clusters_fn.exists():
+        logger.debug('Reuse cluster assignment %s', clusters_fn)
+        clus.clusters = np.load(clusters_fn)
+        clus.nclus = int(clus.clusters.max()) + 1
+    else:
+        # mesh is not dense enough for uniform remeshing
+        # clus.subdivide(3)
+        clus.cluster(n_points)
+        if surface_fn is not None:
+            np.save(clusters_fn, clus.clusters)
     remeshed = clus.create_mesh()
 
     normals = calculate_normals(remeshed)
 
-    write_mesh(args.output, normals)
+    write_mesh(output_filename, normals)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fast marching (level set).')
+    parser.add_argument('input', help='Input segmentation filename', metavar='<input>', nargs='?')
+    parser.add_argument('output', help='Output vtp/xml filename', metavar='<output>', nargs='?')
+    parser.add_argument('--points', help='Number of pints in the mesh. default: %(default)s', type=int, default=80000)
+    parser.add_argument(
+        '--engine',
+        help='Surface extraction and smoothing. numpy: marching cubes within the label bounding box and Taubin '
+        'smoothing on arrays. default: %(default)s',
+        choices=['vtk', 'numpy'],
+        default='vtk',
+    )
+    parser.add_argument(
+        '--cache_dir', help='Cache the smoothed surface in this directory to skip surface extraction on reruns'
+    )
+    parser.add_argument(
+        '--warm_start',
+        help='Reuse the cached cluster assignment computed before with the same number of points',
+        action='store_true',
+    )
+    add_batch_arguments(parser)
+    args = parser.parse_args()
+    if args.warm_start and args.cache_dir is None:
+        parser.error('--warm_start requires --cache_dir')
+
+    if args.batch:
+        pairs = read_batch(args.batch)
+    elif args.input and args.output:
+        pairs = [(args.input, args.output)]
+    else:
+        parser.error('Specify either <input> and <output>, or --batch')
+
+    if len(pairs) == 1:
+        create_mesh(*pairs[0], args.points, args.engine, args.cache_dir, args.warm_start)
+    else:
+        mems = [MEM_FACTOR * estimate_image_bytes(infn) for infn, _ in pairs]
+        tasks = [(infn, outfn, args.points, args.engine, args.cache_dir, args.warm_start) for infn, outfn in pairs]
+        run_parallel(create_mesh, tasks, mems, args.jobs, args.mem_budget)
 
 
 if __name__ == '__main__':
@@ -4,75 +4,137 @@ import sys
 
 import numpy as np
 import SimpleITK as sitk
+import utils
 from logzero import logger
 from szkmipy import boundingbox
 
 
-def main():
-    parser = argparse.ArgumentParser(description='Fast marching (level set).')
-    parser.add_argument('input', help='Input filename', metavar='<input>')
-    parser.add_argument('output', help='Output filename', metavar='<output>')
-    parser.add_argument('--factor', help='Normalization factor. default: %(default)s', default=100)
-    parser.add_argument('--stop', help='Stopping time. default: %(default)s', default=80)
-
-    args = parser.parse_args()
+TIME_THRESHOLD = 100
+MEM_FACTOR = 24  # rough peak memory usage relative to the input segmentation (uint8)
 
-    inputImage = sitk.ReadImage(args.input)
 
+def downsampled_grid(inputImage: sitk.Image, factor: int = 2) -> sitk.Image:
+    '''
+    Empty image defining the grid of the downsampled image
+    '''
     orig_spacing = np.array(inputImage.GetSpacing())
-    if np.all(orig_spacing < 1.0):
-        resample = sitk.ResampleImageFilter()
-        resample.SetInterpolator(sitk.sitkGaussian)
-        resample.SetOutputDirection(inputImage.GetDirection())
-        resample.SetOutputOrigin(inputImage.GetOrigin())
-        resample.SetOutputPixelType(sitk.sitkFloat32)
-
-        new_spacing = (2 * orig_spacing).tolist()
-        resample.SetOutputSpacing(new_spacing)
-        orig_size = np.array(inputImage.GetSize())
-        new_size = np.ceil(orig_size / 2).astype(int).tolist()
-        resample.SetSize(new_size)
-        resampled = resample.Execute(inputImage)
-
-        thresholder = sitk.BinaryThresholdImageFilter()
-        thresholder.SetLowerThreshold(0.25)
-        thresholder.SetUpperThreshold(10)
-        thresholder.SetInsideValue(1)
-        thresholder.SetOutsideValue(0)
-        inputImage = thresholder.Execute(resampled)
+    orig_size = np.array(inputImage.GetSize())
+    new_size = np.ceil(orig_size / factor).astype(int).tolist()
+    grid = sitk.Image(new_size, sitk.sitkUInt8)
+    grid.SetSpacing((factor * orig_spacing).tolist())
+    grid.SetOrigin(inputImage.GetOrigin())
+    grid.SetDirection(inputImage.GetDirection())
+    return grid
 
-    seg_arr = sitk.GetArrayFromImage(inputImage)
+
+def output_grid(inputImage: sitk.Image, multires: bool) -> sitk.Image:
+    '''
+    Grid of the output of `fast_marching` or `fast_marching_multires`
+    '''
+    if not multires and np.all(np.array(inputImage.GetSpacing()) < 1.0):
+        return downsampled_grid(inputImage)
+    return inputImage
+
+
+def downsample(inputImage: sitk.Image, factor: int = 2) -> sitk.Image:
+    '''
+    Downsample binary image by `factor`
+    '''
+    resample = sitk.ResampleImageFilter()
+    resample.SetInterpolator(sitk.sitkGaussian)
+    resample.SetReferenceImage(downsampled_grid(inputImage, factor))
+    resample.SetOutputPixelType(sitk.sitkFloat32)
+    resampled = resample.Execute(inputImage)
+
+    thresholder = sitk.BinaryThresholdImageFilter()
+    thresholder.SetLowerThreshold(0.25)
+    thresholder.SetUpperThreshold(10)
+    thresholder.SetInsideValue(1)
+    thresholder.SetOutsideValue(0)
+    return thresholder.Execute(resampled)
+
+
+def corner_seeds(seg_arr: np.ndarray):
+    '''
+    Seed points (xyz) at the corners of the (padded) bounding box
+    '''
     bmin, bmax = boundingbox.bbox(seg_arr)
     bmin = np.clip(bmin - 1, 0, None)
     bmax = np.clip(bmax + 1, None, seg_arr.shape)
     bmid = np.round((bmin + bmax) / 2).astype(int)
     bbox = [bmin, bmid, bmax]
 
-    dist_filter = sitk.SignedMaurerDistanceMapImageFilter()
-    dist_filter.UseImageSpacingOn()
-    dist_image = dist_filter.Execute(inputImage)
-    fastMarching = sitk.FastMarchingImageFilter()
-
-    timeThreshold = 100
-
+    seeds = []
     for x, y, z in itertools.product([0, 2], [0, 2], [0, 2]):
         # if x == 1 and y == 1 and z == 1:
         #     continue
-        trialPoint = (int(bbox[x][2]), int(bbox[y][1]), int(bbox[z][0]))
+        seeds.append((int(bbox[x][2]), int(bbox[y][1]), int(bbox[z][0])))
+    return seeds
+
+
+def crop_to_bbox(inputImage: sitk.Image, margin: int, align: int = 2) -> sitk.Image:
+    '''
+    Crop image to the bounding box of the segmentation padded by `margin` voxels.
+    Start index is a multiple of `align` so that downsampled grids of the cropped and the original images coincide.
+    '''
+    seg_arr = sitk.GetArrayViewFromImage(inputImage)
+    bmin, bmax = boundingbox.bbox(seg_arr)
+    bmin = np.clip(bmin - margin, 0, None) // align * align
+    bmax = np.clip(bmax + margin, None, seg_arr.shape)
+    # xyz order
+    return sitk.RegionOfInterest(inputImage, (bmax - bmin)[::-1].tolist(), bmin[::-1].tolist())
+
+
+def uncrop(cropped: sitk.Image, grid: sitk.Image) -> sitk.Image:
+    '''
+    Paste cropped image back into `grid`
+    '''
+    return sitk.Resample(cropped, grid, sitk.Transform(), sitk.sitkNearestNeighbor, 0, cropped.GetPixelID())
+
+
+def arrival_times(speed: sitk.Image, seeds, factor: float, stop: float) -> sitk.Image:
+    '''
+    seeds: list of xyz indices optionally followed by (unsigned integer) initial values
+    '''
+    fastMarching = sitk.FastMarchingImageFilter()
+    for trialPoint in seeds:
         fastMarching.AddTrialPoint(trialPoint)
 
-    fastMarching.SetNormalizationFactor(args.factor)
+    fastMarching.SetNormalizationFactor(factor)
+
+    fastMarching.SetStoppingValue(stop)
 
-    fastMarching.SetStoppingValue(args.stop)
+    return fastMarching.Execute(speed)
 
-    fastMarchingOutput = fastMarching.Execute(dist_image)
 
+def threshold(times: sitk.Image) -> sitk.Image:
     thresholder = sitk.BinaryThresholdImageFilter()
     thresholder.SetLowerThreshold(0.0)
-    thresholder.SetUpperThreshold(timeThreshold)
+    thresholder.SetUpperThreshold(TIME_THRESHOLD)
     thresholder.SetOutsideValue(1)
     thresholder.SetInsideValue(0)
-    threshed = thresholder.Execute(fastMarchingOutput)
+    return thresholder.Execute(times)
+
+
+def distance_map(inputImage: sitk.Image) -> sitk.Image:
+    dist_filter = sitk.SignedMaurerDistanceMapImageFilter()
+    dist_filter.UseImageSpacingOn()
+    return dist_filter.Execute(inputImage)
+
+
+def fast_marching(inputImage: sitk.Image, factor: float = 100, stop: float = 80) -> sitk.Image:
+    '''
+    Fill cavities in the segmentation. Image is downsampled if its spacing is finer than 1 mm.
+    '''
+    orig_spacing = np.array(inputImage.GetSpacing())
+    if np.all(orig_spacing < 1.0):
+        inputImage = downsample(inputImage)
+
+    seg_arr = sitk.GetArrayFromImage(inputImage)
+    seeds = corner_seeds(seg_arr)
+    dist_image = distance_map(inputImage)
+    fastMarchingOutput = arrival_times(dist_image, seeds, factor, stop)
+    threshed = threshold(fastMarchingOutput)
 
     result = threshed
     # erosion = sitk.BinaryErodeImageFilter()
@@ -80,8 +142,138 @@ def main():
     # erosion.SetForegroundValue(1)
     # erosion.SetKernelRadius(1)
     # result = erosion.Execute(threshed)
+    return result
+
+
+def fast_marching_multires(
+    inputImage: sitk.Image, factor: float = 100, stop: float = 80, band: float = 3.0, coarse_factor: int = 2
+) -> sitk.Image:
+    '''
+    Solve arrival times on a coarse grid then refine them at full resolution within a narrow band
+    (`band` mm on each side) around the coarse boundary.
+    Full resolution front starts from the outer edge of the band with the (interpolated) coarse arrival times.
+    '''
+    coarse = downsample(inputImage, coarse_factor)
+    coarse_times = arrival_times(distance_map(coarse), corner_seeds(sitk.GetArrayFromImage(coarse)), factor, stop)
+    coarse_result = threshold(coarse_times)
+
+    radius = np.ceil(band / np.array(coarse.GetSpacing())).astype(int).tolist()
+    dilated = sitk.BinaryDilate(coarse_result, radius, sitk.sitkBox)
+    eroded = sitk.BinaryErode(coarse_result, radius, sitk.sitkBox)
+    coarse_band = sitk.Xor(dilated, eroded)
+
+    def upsample(image, interpolator):
+        resample = sitk.ResampleImageFilter()
+        resample.SetReferenceImage(inputImage)
+        resample.SetInterpolator(interpolator)
+        resample.SetOutputPixelType(image.GetPixelID())
+        resample.UseNearestNeighborExtrapolatorOn()  # the last slices can be outside of the coarse grid
+        return resample.Execute(image)
+
+    times = sitk.GetArrayFromImage(upsample(coarse_times, sitk.sitkLinear))
+    result = sitk.GetArrayFromImage(upsample(coarse_result, sitk.sitkNearestNeighbor))
+    in_band = sitk.GetArrayFromImage(upsample(coarse_band, sitk.sitkNearestNeighbor)) > 0
+    logger.debug('Band: %d voxels (%.1f%%)', in_band.sum(), 100 * in_band.mean())
+
+    # zero speed outside of the band stops the front
+    dist_image = distance_map(inputImage)
+    speed = sitk.GetArrayFromImage(dist_image)
+    speed[~in_band] = 0
+    speed_image = sitk.GetImageFromArray(speed)
+    speed_image.CopyInformation(dist_image)
+
+    outside = np.logical_and(~in_band, result == 0)
+    struct = sitk.GetArrayFromImage(sitk.BinaryDilate(sitk.GetImageFromArray(outside.astype(np.uint8)), [1] * 3))
+    edge = np.logical_and(in_band, struct > 0)
+    # initial values of trial points need to be integers. scale times for precision.
+    scale = 1000
+    seed_times = np.round(np.minimum(times[edge], 2 * TIME_THRESHOLD) * scale).astype(int)
+    seeds = [(int(x), int(y), int(z), int(t)) for (z, y, x), t in zip(np.argwhere(edge), seed_times)]
+    logger.debug('Seeds: %d', len(seeds))
+    fine_times = arrival_times(speed_image, seeds, factor * scale, stop * scale) / scale
+    fine = sitk.GetArrayFromImage(threshold(fine_times))
+    result[in_band] = fine[in_band]
+
+    result_image = sitk.GetImageFromArray(result)
+    result_image.CopyInformation(inputImage)
+    return result_image
+
+
+def compare(result: sitk.Image, reference: sitk.Image):
+    '''
+    Log agreement between `result` and `reference` on the grid of `result`.
+    '''
+    reference = sitk.Resample(reference, result, sitk.Transform(), sitk.sitkNearestNeighbor, 0, result.GetPixelID())
+    a = sitk.GetArrayViewFromImage(result) > 0
+    b = sitk.GetArrayViewFromImage(reference) > 0
+    dice = 2 * np.logical_and(a, b).sum() / max(a.sum() + b.sum(), 1)
+    n_diff = np.logical_xor(a, b).sum()
+    logger.info('Dice: %.5f, different voxels: %d (%.3f%%)', dice, n_diff, 100 * n_diff / a.size)
+
+
+def process(input_filename: str, output_filename: str, args: argparse.Namespace):
+    inputImage = sitk.ReadImage(input_filename)
+    cropped = inputImage
+    if args.margin is not None:
+        cropped = crop_to_bbox(inputImage, args.margin)
+        logger.debug('Crop %s -> %s', inputImage.GetSize(), cropped.GetSize())
+
+    if args.multires:
+        result = fast_marching_multires(cropped, args.factor, args.stop, args.band)
+        if args.report:
+            compare(result, fast_marching(cropped, args.factor, args.stop))
+    else:
+        result = fast_marching(cropped, args.factor, args.stop)
+
+    if args.margin is not None and not args.crop_output:
+        result = uncrop(result, output_grid(inputImage, args.multires))
+
+    sitk.WriteImage(result, output_filename, useCompression=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fast marching (level set).')
+    parser.add_argument('input', help='Input filename', metavar='<input>', nargs='?')
+    parser.add_argument('output', help='Output filename', metavar='<output>', nargs='?')
+    parser.add_argument('--factor', help='Normalization factor. default: %(default)s', default=100, type=float)
+    parser.add_argument('--stop', help='Stopping time. default: %(default)s', default=80, type=float)
+    parser.add_argument(
+        '--multires', help='Refine coarse solution within narrow band at full resolution', action='store_true'
+    )
+    parser.add_argument('--band', help='Band width (mm) for --multires. default: %(default)s', default=3.0, type=float)
+    parser.add_argument(
+        '--report', help='Report accuracy of --multires compared to the single resolution', action='store_true'
+    )
+    parser.add_argument(
+        '--margin',
+        help='Process only the bounding box of the segmentation padded by this many voxels. Fronts going around '
+        'outside of the box are lost, which changes the result unless the margin is large (e.g. 40). '
+        'Whole image by default.',
+        type=int,
+    )
+    parser.add_argument(
+        '--crop_output',
+        help='Output cropped image (--margin) instead of the original geometry. Origin is adjusted accordingly.',
+        action='store_true',
+    )
+    utils.add_batch_arguments(parser)
+
+    args = parser.parse_args()
+    if args.crop_output and args.margin is None:
+        parser.error('--crop_output requires --margin')
+
+    if args.batch:
+        pairs = utils.read_batch(args.batch)
+    elif args.input and args.output:
+        pairs = [(args.input, args.output)]
+    else:
+        parser.error('Specify either <input> and <output>, or --batch')
 
-    sitk.WriteImage(result, args.output, useCompression=True)
+    if len(pairs) == 1:
+        process(*pairs[0], args)
+    else:
+        mems = [MEM_FACTOR * utils.estimate_image_bytes(infn) for infn, _ in pairs]
+        utils.run_parallel(process, [(infn, outfn, args) for infn, outfn in pairs], mems, args.jobs, args.mem_budget)
 
 
 if __name__ == '__main__':
@@ -1,12 +1,14 @@
 # %%
 import sys
 from pathlib import Path
-from typing import Dict, List, Tuple, Union
+from typing import TYPE_CHECKING, Dict, List, Tuple, Union
 
 import numpy as np
 from pydantic import BaseModel
-from scipy.spatial.transform import Rotation as R
-from vtkmodules.vtkCommonDataModel import vtkPointLocator, vtkPolyData
+
+
+if TYPE_CHECKING:
+    from vtkmodules.vtkCommonDataModel import vtkPolyData
 
 
 class ControlPoint(BaseModel):
@@ -42,12 +44,14 @@ def to_dict(lms: Landmarks) -> LandmarkDict:
     return {lm.label: lm for lm in lms}
 
 
-def locate_landmarks(mesh: vtkPolyData, landmarks: Landmarks) -> List[int]:
+def locate_landmarks(mesh: 'vtkPolyData', landmarks: Landmarks) -> List[int]:
     '''
     Find closest point of lanrmarks on the mesh.
 
     return: point ids
     '''
+    from vtkmodules.vtkCommonDataModel import vtkPointLocator
+
     locator = vtkPointLocator()
     locator.SetDataSet(mesh)
     locator.SetNumberOfPointsPerBucket(1)
@@ -73,6 +77,8 @@ class CameraPresets(BaseModel):
 
 
 def create_camera_preset(landmarks: Landmarks) -> CameraPresets:
+    from scipy.spatial.transform import Rotation as R
+
     d_lm = {l: np.array(lm.position) for l, lm in to_dict(landmarks).items()}
 
     focal_point = (d_lm['Lamda'] + d_lm['Subspinale']) / 2
@@ -5,14 +5,34 @@ import argparse
 import logzero
 import utils
 from logzero import logger
-from tqdm import tqdm
 
+MEM_FACTOR = 6  # rough peak memory usage relative to the input image
+SLAB_MEM_FACTOR = 5  # with --slab
+
+
+def do(fn: Path, slab_size=None, n_jobs=1):
+    utils.logger.setLevel(logzero.INFO)
+    output = fn.with_name(fn.stem + '_wo_bed.mha')
+    if output.exists():
+        logger.info('Skip: %s', fn)
+        return
+    logger.info('Process: %s', fn)
+    try:
+        utils.remove_bed(fn, output, slab_size=slab_size, n_jobs=n_jobs)
+    except Exception as e:
+        print(fn)
+        print(e)
 
 
 def main():
     parser = argparse.ArgumentParser(
         description='Remove bed')
     parser.add_argument('input', help='Input directory')
+    parser.add_argument('--slab', help='Process in z-slabs of this many slices to save memory', type=int)
+    parser.add_argument(
+        '--slab-threads', help='Number of threads per image for --slab. default: %(default)s', type=int, default=1
+    )
+    utils.add_scheduler_arguments(parser)
     args = parser.parse_args()
 
 
@@ -21,27 +41,12 @@ def main():
     fns = [fn for fn in fns if 'wo_bed' not in fn.name]
     print(len(fns), 'files')
 
-
-    def do(fn):
-        utils.logger.setLevel(logzero.INFO)
-        output = fn.with_name(fn.stem + '_wo_bed.mha')
-        if output.exists():
-            logger.info('Skip: %s', fn)
-            return
-        logger.info('Process: %s', fn)
-        try:
-            utils.remove_bed(fn, output)
-        except Exception as e:
-            print(fn)
-            print(e)
-
-
-    from joblib import Parallel, delayed
-
-
-    Parallel(n_jobs=8)(delayed(do)(fn) for fn in tqdm(fns))
+    mem_factor = MEM_FACTOR if args.slab is None else SLAB_MEM_FACTOR
+    mems = [mem_factor * utils.estimate_image_bytes(fn) for fn in fns]
+    tasks = [(fn, args.slab, args.slab_threads) for fn in fns]
+    utils.run_parallel(do, tasks, mems, args.jobs, args.mem_budget)
 
 
 
 if __name__ == '__main__':
-    sys.exit(main())
\ No newline at end of file
+    sys.exit(main())
@@ -1,82 +1,114 @@
 from pathlib import Path
+from typing import Optional
 import numpy as np
 from scipy import ndimage
 import sys
 import argparse
 
 import cc3d
-import tqdm
 import utils
-from joblib import Parallel, delayed
 from logzero import logger
+from szkmipy import boundingbox as bb
 from szkmipy import mhd
 
 
-def segment_bone(mha_fn: str, out_fn: str):
+VC_THRESH = 800
+MEM_FACTOR = 8  # rough peak memory usage relative to the input image
+
+
+def fill2d(vol: np.ndarray, vc_thresh: int, output: Optional[np.ndarray] = None) -> np.ndarray:
+    '''
+    Fill holes in each axial slice except for holes larger than `vc_thresh` pixels.
+    All slices are processed at once using structures without connectivity along z.
+    '''
+    st = np.zeros((3, 3, 3), dtype=bool)
+    st[1] = ndimage.generate_binary_structure(2, 1)
+    if output is None:
+        output = np.empty(vol.shape, dtype=bool)
+    # fill holes: background regions not touching the in-plane border
+    labels_out, n = ndimage.label(np.logical_not(vol), structure=st)
+    outside = np.zeros(n + 1, dtype=bool)
+    for border in [labels_out[:, 0], labels_out[:, -1], labels_out[:, :, 0], labels_out[:, :, -1]]:
+        outside[border] = True
+    outside[0] = False
+    np.logical_not(outside[labels_out], out=output)
+    holes = np.logical_xor(output, vol)
+    st[1] = True  # 8-connectivity (default of 2d cc3d.connected_components)
+    ndimage.label(holes, structure=st, output=labels_out)  # reuse buffer
+    del holes
+    large = np.bincount(labels_out.ravel()) > vc_thresh
+    large[0] = False
+    output[large[labels_out]] = 0
+    return output
+
+
+def segment_bone(mha_fn: str, out_fn: str, slab_size: Optional[int] = None):
     if Path(out_fn).exists():
         logger.info('Skip: %s', mha_fn)
         return
-    vol, h = mhd.read(mha_fn)
+    vol, h = utils.read_image(mha_fn)
     if vol.dtype != np.int16:
         logger.info('Skip (not int16 image): %s', mha_fn)
         return
 
-    logger.info('Process: %s', mha_fn)
+    with utils.PeakRSS() as rss:
+        logger.info('Process: %s', mha_fn)
 
-    try:
-        body, dilated_body = utils.segment_body(vol)
-    except Exception as e:
-        logger.error('Failed to segment body from %s: %s', mha_fn, e)
-        return
-
-    iterations = 3
-    eroded = ndimage.binary_erosion(body, structure=np.ones((3, 3, 3)), iterations=iterations)
-    h['CompressedData'] = True
-    thresh = 400
-    bone = vol > thresh
-    bone[eroded == 0] = 0
-
-    filled = ndimage.binary_fill_holes(bone, structure=np.ones((3, 3, 3)))
-
-    largest = cc3d.largest_k(filled, k=1, connectivity=6) > 0
+        try:
+            body, _ = utils.segment_body(vol, slab_size)
+        except Exception as e:
+            logger.error('Failed to segment body from %s: %s', mha_fn, e)
+            return
 
-    VC_THRESH = 800
+        iterations = 3
+        # everything outside of the (eroded) body is background. crop to save memory.
+        bbox = bb.bbox(body)
+        margin = iterations + 1
+        body = bb.crop(body, bbox, margin=margin)
+        eroded = ndimage.binary_erosion(body, structure=np.ones((3, 3, 3)), iterations=iterations)
+        del body
+        h['CompressedData'] = True
+        thresh = 400
+        bone = bb.crop(vol, bbox, margin=margin) > thresh
+        bone &= eroded
+        del eroded
 
-    st2d = ndimage.generate_binary_structure(2, 1)
+        ndimage.binary_fill_holes(bone, structure=np.ones((3, 3, 3)), output=bone)
 
-    def fill2d(s):
-        filled = ndimage.binary_fill_holes(s, structure=st2d)
-        holes = np.logical_xor(filled, s)
-        labels_out = cc3d.connected_components(holes)
-        stats = cc3d.statistics(labels_out)
-        for i, vc in enumerate(stats['voxel_counts'][1:], 1):
-            if vc > VC_THRESH:
-                filled[labels_out == i] = 0
-        return filled
+        largest = cc3d.largest_k(bone, k=1, connectivity=6, binary_image=True) > 0
 
-    f2d = [fill2d(s) for s in largest]
-    f2d = np.stack(f2d).astype(np.uint8)
-    st = ndimage.generate_binary_structure(3, 1)
-    filled = ndimage.binary_fill_holes(f2d, structure=st)
+        f2d = bone  # reuse buffer
+        fill2d(largest, VC_THRESH, output=f2d)
+        del largest
+        st = ndimage.generate_binary_structure(3, 1)
+        ndimage.binary_fill_holes(f2d, structure=st, output=f2d)
+        filled = bb.uncrop(f2d.view(np.uint8), vol.shape, bbox, margin=margin, constant_values=0)
 
+        mhd.write(out_fn, filled, h)
+    if rss.peak_mb is not None:
+        logger.info('Peak RSS: %.1f MiB (+%.1f MiB, %s)', rss.peak_mb, rss.peak_mb - rss.start_mb, mha_fn)
 
-    mhd.write(out_fn, filled, h)
 
 def main():
     parser = argparse.ArgumentParser(
         description='Segment bone.')
     parser.add_argument('input', help='Input directory')
+    parser.add_argument('--slab', help='Segment body in z-slabs of this many slices to save memory', type=int)
+    utils.add_scheduler_arguments(parser)
 
     args = parser.parse_args()
     indir = Path(args.input)
     fns = sorted(indir.glob('**/*_wo_bed.mha'))
 
 
-    args = [(str(fn), str(fn.parent / '{}_auto_skull.mha'.format(fn.stem.replace('_wo_bed', '')))) for fn in fns]
+    all_args = [
+        (str(fn), str(fn.parent / '{}_auto_skull.mha'.format(fn.stem.replace('_wo_bed', ''))), args.slab) for fn in fns
+    ]
 
 
     logger.info('start')
-    Parallel(n_jobs=4)(delayed(segment_bone)(*arg) for arg in tqdm.tqdm(args))
+    mems = [MEM_FACTOR * utils.estimate_image_bytes(fn) for fn in fns]
+    utils.run_parallel(segment_bone, all_args, mems, args.jobs, args.mem_budget)
     logger.info('done')
 
 if __name__ == '__main__':
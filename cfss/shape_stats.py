@@ -3,7 +3,7 @@ import os
 import sys
 from functools import wraps
 from pathlib import Path
-from typing import Callable
+from typing import Callable, Optional
 
 import numpy as np
 import PyQt5
@@ -12,15 +12,16 @@ from logzero import logger
 from PyQt5 import QtCore, QtWidgets
 from PyQt5.QtCore import Qt
 from PyQt5.QtWidgets import QApplication, QWidget
-from ssm import PCAStats
+from ssm import MorphEngine, PCAStats, is_matrix_outdated, is_model_outdated
+from utils import decimate
 
 # vtk
 from vtkmodules.qt.QVTKRenderWindowInteractor import QVTKRenderWindowInteractor
 from vtkmodules.util.numpy_support import numpy_to_vtk, vtk_to_numpy
 from vtkmodules.vtkCommonColor import vtkNamedColors
 from vtkmodules.vtkCommonCore import vtkIdTypeArray
-from vtkmodules.vtkCommonDataModel import vtkSelection, vtkSelectionNode
-from vtkmodules.vtkFiltersCore import vtkGlyph3D, vtkPolyDataNormals
+from vtkmodules.vtkCommonDataModel import vtkPolyData, vtkSelection, vtkSelectionNode
+from vtkmodules.vtkFiltersCore import vtkGlyph3D
 from vtkmodules.vtkFiltersExtraction import vtkExtractSelection
 from vtkmodules.vtkFiltersSources import vtkSphereSource
 from vtkmodules.vtkInteractionStyle import vtkInteractorStyleTrackballCamera
@@ -140,10 +141,78 @@ def make_parser():
     parser.add_argument('--max_coef', help='Maximum coeficient. default: %(default)s', default=3, type=int)
     parser.add_argument('--pcs', help='Number of principal components. default: %(default)s', default=3, type=int)
     parser.add_argument('--cameras', help='Camera preset settings (`landmark.CameraPresets`) in json format')
+    parser.add_argument('--matrix', help='Stacked-shape matrix (.npy) created by `ssm.py build_matrix` to load instead')
+    parser.add_argument('--model', help='PCA model (.npz) created by `ssm.py build_model` to load instead of fitting')
+    parser.add_argument(
+        '--lod',
+        help='Number of points of the decimated mesh rendered while dragging sliders. 0 to always render the full '
+        'resolution mesh. default: %(default)s',
+        default=0,
+        type=int,
+    )
 
     return parser
 
 
+def normals_view(mesh) -> np.ndarray:
+    '''
+    numpy view of the point normals of `mesh`. Normals array is added if missing.
+    '''
+    if mesh.GetPointData().GetNormals() is None:
+        vtk_normals = numpy_to_vtk(np.zeros((mesh.GetNumberOfPoints(), 3), dtype=np.float32), deep=True)
+        vtk_normals.SetName('Normals')
+        mesh.GetPointData().SetNormals(vtk_normals)
+    return vtk_to_numpy(mesh.GetPointData().GetNormals())
+
+
+STAGE_LABELS = {'read': 'Reading meshes', 'fit': 'Fitting PCA'}
+
+
+class ModelLoader(QtCore.QThread):
+    '''
+    Load (or fit) the PCA model in background.
+    `mean_ready` is emitted with the average shape as soon as it is available, then `loaded` with the model.
+    '''
+
+    progress = QtCore.pyqtSignal(str, int, int)  # stage, done, total
+    mean_ready = QtCore.pyqtSignal(object)  # vtkPolyData
+    loaded = QtCore.pyqtSignal(object, object, object)  # PCAStats, decimated mesh and its point ids (None w/o LOD)
+    failed = QtCore.pyqtSignal(str)
+
+    def __init__(self, args: argparse.Namespace, parent=None):
+        super().__init__(parent)
+        self.args = args
+
+    def run(self):
+        args = self.args
+        try:
+            logger.info('Create PCA')
+            indir = Path(args.input)
+            filenames = sorted(indir.glob('*.vtp'))
+            use_model = args.model is not None and not is_model_outdated(args.model, filenames)
+            if args.model and not use_model:
+                logger.warning(f'{args.model} does not match the meshes in {indir}. Run `doit model`')
+            hooks = {'progress': self.progress.emit, 'on_mean': self.mean_ready.emit}
+            if use_model:
+                pca_stats, mesh = PCAStats.from_model(args.model)
+                self.mean_ready.emit(mesh)
+            elif args.matrix:
+                if is_matrix_outdated(args.matrix, filenames):
+                    logger.warning(f'{args.matrix} does not match the meshes in {indir}. Run `doit shape_matrix`')
+                pca_stats, mesh = PCAStats.from_matrix(args.matrix, **hooks)
+            else:
+                pca_stats, mesh = PCAStats.from_files(filenames, **hooks)
+            coarse_mesh, coarse_ids = None, None
+            if args.lod > 0:
+                coarse_mesh, coarse_ids = decimate(mesh, args.lod)
+                logger.info('Decimated mesh for dragging: %d points', coarse_mesh.GetNumberOfPoints())
+            logger.info('Done')
+            self.loaded.emit(pca_stats, coarse_mesh, coarse_ids)
+        except Exception as e:
+            logger.exception('Failed to load the model')
+            self.failed.emit(str(e))
+
+
 class MainWindow(QtWidgets.QMainWindow):
     def __init__(self, parent=None):
         QtWidgets.QMainWindow.__init__(self, parent)
@@ -151,12 +220,11 @@ class MainWindow(QtWidgets.QMainWindow):
         self.resize(1024, 1024)
 
         args = make_parser().parse_args()
+        self.args = args
 
-        logger.info('Create PCA')
-        indir = Path(args.input)
-        filenames = sorted(indir.glob('*.vtp'))
-        pca_stats, mesh = PCAStats.from_files(filenames)
-        logger.info('Done')
+        # filled with the average shape by `show_mean`
+        mesh = vtkPolyData()
+        self.mesh = mesh
 
         self.frame = QtWidgets.QWidget()
 
@@ -166,8 +234,6 @@ class MainWindow(QtWidgets.QMainWindow):
 
         colors = vtkNamedColors()
 
-        mesh_points = vtk_to_numpy(mesh.GetPoints().GetData())
-
         mapper = vtkPolyDataMapper()
         mapper.SetInputData(mesh)
 
@@ -182,6 +248,7 @@ class MainWindow(QtWidgets.QMainWindow):
         ren_win.SetWindowName('PointPicking')
         iren = self.vtkWidget.GetRenderWindow().GetInteractor()
         iren.SetRenderWindow(ren_win)
+        self.ren_win = ren_win
 
         renderer.AddActor(actor)
         renderer.SetBackground(colors.GetColor3d('AliceBlue'))
@@ -190,8 +257,7 @@ class MainWindow(QtWidgets.QMainWindow):
         style = MouseInteractorStyle(mesh)
         style.SetDefaultRenderer(renderer)
         iren.SetInteractorStyle(style)
-
-        self.ren.ResetCamera()
+        self.style = style
 
         self.frame.setLayout(self.vl)
         self.setCentralWidget(self.frame)
@@ -201,6 +267,7 @@ class MainWindow(QtWidgets.QMainWindow):
         dock_widget.setLayout(QtWidgets.QVBoxLayout())
         self.dock.setWidget(dock_widget)
         self.addDockWidget(QtCore.Qt.LeftDockWidgetArea, self.dock)
+        self.dock_widget = dock_widget
 
         group = QtWidgets.QGroupBox('Rendering', self)
         dock_widget.layout().addWidget(group)
@@ -227,17 +294,14 @@ class MainWindow(QtWidgets.QMainWindow):
         combobox.currentIndexChanged.connect(set_representation)
         group.layout().addWidget(combobox)
 
+        self.initial_camera = None
         if args.cameras:
             import landmark
 
             with open(args.cameras) as f:
                 presets = landmark.CameraPresets.model_validate_json(f.read()).presets
             logger.info(f'Initialize camera with {presets[0].name}')
-            param = presets[0].camera
-            cam = self.ren.GetActiveCamera()
-            cam.SetPosition(*param.position)
-            cam.SetViewUp(*param.view_up)
-            cam.SetFocalPoint(*param.focal_point)
+            self.initial_camera = presets[0].camera
 
             group = QtWidgets.QGroupBox('Camera', self)
             dock_widget.layout().addWidget(group)
@@ -261,6 +325,66 @@ class MainWindow(QtWidgets.QMainWindow):
                 button.clicked.connect(camera_callback(preset.camera))
                 group.layout().addWidget(button)
 
+        self.progress_bar = QtWidgets.QProgressBar()
+        self.progress_bar.setMaximum(0)  # busy until the first progress
+        self.statusBar().addPermanentWidget(self.progress_bar)
+        self.statusBar().showMessage('Loading model')
+
+        self.show()
+        iren.Initialize()
+
+        self.loader = ModelLoader(args, self)
+        self.loader.progress.connect(self.show_progress)
+        self.loader.mean_ready.connect(self.show_mean)
+        self.loader.loaded.connect(self.setup_model)
+        self.loader.failed.connect(self.show_error)
+        self.loader.start()
+
+        iren.Start()
+
+    def show_progress(self, stage: str, done: int, total: int):
+        self.progress_bar.setFormat(f'{STAGE_LABELS.get(stage, stage)} %p%')
+        self.progress_bar.setMaximum(total)
+        self.progress_bar.setValue(done)
+
+    def show_mean(self, mean_mesh: vtkPolyData):
+        '''
+        Display the average shape while the model is being loaded
+        '''
+        self.mesh.ShallowCopy(mean_mesh)
+        self.ren.ResetCamera()
+        if self.initial_camera is not None:
+            cam = self.ren.GetActiveCamera()
+            cam.SetPosition(*self.initial_camera.position)
+            cam.SetViewUp(*self.initial_camera.view_up)
+            cam.SetFocalPoint(*self.initial_camera.focal_point)
+        self.ren_win.Render()
+
+    def show_error(self, message: str):
+        self.statusBar().removeWidget(self.progress_bar)
+        self.statusBar().showMessage('Failed to load model')
+        QtWidgets.QMessageBox.critical(self, 'Error', f'Failed to load model:\n{message}')
+
+    def setup_model(self, pca_stats: PCAStats, coarse_mesh: Optional[vtkPolyData], coarse_ids: Optional[np.ndarray]):
+        '''
+        Add the controls that need the model
+        coarse_mesh: Decimated mesh rendered while dragging sliders (LOD) with `coarse_ids` of its points in the mesh
+        '''
+        args, mesh, actor, renderer = self.args, self.mesh, self.actor, self.ren
+        ren_win, style, dock_widget = self.ren_win, self.style, self.dock_widget
+        mesh_points = vtk_to_numpy(mesh.GetPoints().GetData())
+
+        # decimated mesh rendered while dragging sliders. picking and distances use the full resolution mesh.
+        if coarse_mesh is not None:
+            coarse_mapper = vtkPolyDataMapper()
+            coarse_mapper.SetInputData(coarse_mesh)
+            coarse_actor = vtkActor()
+            coarse_actor.SetProperty(actor.GetProperty())
+            coarse_actor.SetMapper(coarse_mapper)
+            coarse_actor.PickableOff()
+            coarse_actor.VisibilityOff()
+            renderer.AddActor(coarse_actor)
+
         group = QtWidgets.QGroupBox('Distance', self)
         group.setToolTip('Euclidean distance between two points')
         dock_widget.layout().addWidget(group)
@@ -285,12 +409,12 @@ class MainWindow(QtWidgets.QMainWindow):
 
         def calc_callback():
             logger.debug(f'Calc stats for {style.pids[0]} and {style.pids[1]}')
-            dists = pca_stats.dists_between(style.pids[0], style.pids[1])
+            stats = pca_stats.distance_stats([(style.pids[0], style.pids[1])])
             p1 = np.array(mesh.GetPoint(style.pids[0]))
             p2 = np.array(mesh.GetPoint(style.pids[1]))
             cur_dist = np.linalg.norm(p1 - p2)
-            d_mean = dists.mean()
-            d_std = dists.std()
+            d_mean = stats.mean[0]
+            d_std = stats.std[0]
             text1 = f'Current:\n {cur_dist:.2f} mm'
             if d_std > 0:
                 score = (cur_dist - d_mean) / d_std
@@ -313,7 +437,7 @@ class MainWindow(QtWidgets.QMainWindow):
         dock_widget.layout().addWidget(group)
         group.setLayout(QtWidgets.QVBoxLayout())
 
-        data_list = ['average'] + [f'case {i+1}' for i in range(len(pca_stats.components))]
+        data_list = ['average'] + [f'case {i+1}' for i in range(len(pca_stats.all_coefs))]
         morph_slider = QtWidgets.QSlider(Qt.Orientation.Horizontal)
         morph_slider.setMaximum(max(100, args.morph_max))
         morph_slider.setMinimum(min(0, 0 - (args.morph_max - 100)))
@@ -335,9 +459,18 @@ class MainWindow(QtWidgets.QMainWindow):
             else:
                 morph_group.layout().addWidget(combobox)
 
-        normal_filter = vtkPolyDataNormals()
-        normal_filter.SetInputData(mesh)
-        normal_filter.SplittingOff()
+        # points and normals are updated in place by `engine` through numpy views of the persistent vtk arrays
+        faces = vtk_to_numpy(mesh.GetPolys().GetConnectivityArray()).reshape(-1, 3)
+        mesh_normals = normals_view(mesh)
+
+        def update_engines(dragging: bool, func: Callable[[MorphEngine], None]):
+            '''
+            Apply `func` only to the coarse engine while dragging with LOD, otherwise to all the engines
+            '''
+            dragging = dragging and coarse_mesh is not None
+            for e in [coarse_engine] if dragging else engines:
+                func(e)
+            update_shape(dragging)
 
         def morph_slider_callback():
             morph_slider.setToolTip(f'{slider.value()}')
@@ -345,13 +478,12 @@ class MainWindow(QtWidgets.QMainWindow):
             logger.debug('Morph slider changed: %s', value)
             idx1, idx2 = morph_boxes[0].currentIndex(), morph_boxes[1].currentIndex()
             # mean shape is `idx1 == 0 `
-            zeros = np.zeros_like(pca_stats.all_coefs[0])
-            coef1 = zeros if idx1 == 0 else pca_stats.all_coefs[idx1 - 1]
-            coef2 = zeros if idx2 == 0 else pca_stats.all_coefs[idx2 - 1]
-            coef = (1 - value) * coef1 + value * coef2
-            set_coef(coef)
+            case1, case2 = None if idx1 == 0 else idx1 - 1, None if idx2 == 0 else idx2 - 1
+            update_engines(morph_slider.isSliderDown(), lambda e: e.morph(case1, case2, value))
 
         morph_slider.valueChanged.connect(morph_slider_callback)
+        if coarse_mesh is not None:
+            morph_slider.sliderReleased.connect(morph_slider_callback)
         group.layout().addWidget(morph_slider)
 
         group = QtWidgets.QGroupBox('PCA', self)
@@ -364,17 +496,15 @@ class MainWindow(QtWidgets.QMainWindow):
 
         def pc_callback(index: int):
             def callback():
-                coef = pca_stats.pca.transform(mesh_points.ravel()[np.newaxis])[0]
-                value = pc_sliders[index].value() / PC_DENOM
-                coef[index] = value * np.sqrt(pca_stats.pca.explained_variance_[index])
-                set_coef(coef)
+                value = pc_sliders[index].value() / PC_DENOM * np.sqrt(pca_stats.explained_variance[index])
+                update_engines(pc_sliders[index].isSliderDown(), lambda e: e.set_mode(index, value))
 
             return callback
 
         pca_label = QtWidgets.QLabel('magnitude = 0')
         pca_label.setToolTip('Magnitude of coefficients')
         group.layout().addWidget(pca_label)
-        n_pcs = min(args.pcs, len(filenames) - 1)
+        n_pcs = min(args.pcs, len(pca_stats.components), len(pca_stats.all_coefs) - 1)
         logger.info('Number of PCs: %d', n_pcs)
         for i in range(n_pcs):
             group.layout().addWidget(QtWidgets.QLabel(f'PC {i+1}'))
@@ -384,37 +514,56 @@ class MainWindow(QtWidgets.QMainWindow):
             slider.setValue(0)
             pc_sliders.append(slider)
             slider.valueChanged.connect(pc_callback(i))
+            if coarse_mesh is not None:
+                slider.sliderReleased.connect(pc_callback(i))
             group.layout().addWidget(slider)
 
-        def set_coef(coef):
-            normed_coef = coef / np.sqrt(pca_stats.pca.explained_variance_)
+        engine = MorphEngine(pca_stats, mesh_points, n_pcs, faces, mesh_normals)
+        engines = [engine]
+        if coarse_mesh is not None:
+            coarse_points = vtk_to_numpy(coarse_mesh.GetPoints().GetData())
+            coarse_faces = vtk_to_numpy(coarse_mesh.GetPolys().GetConnectivityArray()).reshape(-1, 3)
+            coarse_stats = pca_stats.subset(coarse_ids)
+            coarse_engine = MorphEngine(coarse_stats, coarse_points, n_pcs, coarse_faces, normals_view(coarse_mesh))
+            engines.append(coarse_engine)
+
+        def update_shape(dragging: bool = False):
+            '''
+            Reflect the shape and the coefficients of `engine`, or `coarse_engine` while dragging
+            '''
+            shown_engine, shown_mesh = (coarse_engine, coarse_mesh) if dragging else (engine, mesh)
+            normed_coef = shown_engine.coef / np.sqrt(pca_stats.explained_variance)
             pca_label.setText(f'magnitude = {np.linalg.norm(normed_coef):.02f}')
             for i, slider in enumerate(pc_sliders):
                 slider.blockSignals(True)
                 c = normed_coef[i]
                 slider.setValue(int(PC_DENOM * c))
                 slider.blockSignals(False)
-            mesh_points[:] = pca_stats.pca.inverse_transform(coef[np.newaxis])[0].reshape(
-                -1, 3
-            )  # pca_stats.mean + coef * pca_stats.components
-            mesh.GetPoints().SetData(numpy_to_vtk(mesh_points))
-            normal_filter.Update()
-            normals = normal_filter.GetOutput()
-            mesh.GetCellData().SetNormals(normals.GetCellData().GetNormals())  # TODO: is this actually working?
-            mesh.Modified()
+            shown_mesh.GetPoints().Modified()
+            shown_mesh.GetPointData().GetNormals().Modified()
+            shown_mesh.Modified()
+            if coarse_mesh is not None:
+                coarse_actor.SetVisibility(dragging)
+                actor.SetVisibility(not dragging)
             ren_win.Render()
-            calc_callback()
+            if not dragging:
+                calc_callback()
 
         dock_widget.layout().addStretch(1)
 
-        self.show()
-        iren.Initialize()
-        iren.Start()
+        self.statusBar().removeWidget(self.progress_bar)
+        self.statusBar().showMessage(f'Loaded {len(pca_stats.all_coefs)} cases', 5000)
+        # the engines overwrite the points and the normals in place
+        update_shape()
 
 
-if __name__ == "__main__":
+def main():
     app = QtWidgets.QApplication(sys.argv)
 
     window = MainWindow()
 
-    sys.exit(app.exec_())
+    return app.exec_()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,27 +1,320 @@
+import argparse
+import json
+import sys
 from pathlib import Path
-from typing import List, Tuple, Union
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple, Union
 
 import numpy as np
+from logzero import logger
 from sklearn.decomposition import PCA
-from utils import calculate_normals, read_mesh
+from utils import (
+    arrays_to_mesh,
+    calculate_normals,
+    face_normals,
+    normalize_rows,
+    read_mesh,
+    vertex_face_incidence,
+    write_mesh,
+)
 from vtkmodules.util.numpy_support import numpy_to_vtk, vtk_to_numpy
 from vtkmodules.vtkCommonDataModel import vtkPolyData
 
 
+MTIME_TOLERANCE = 2.0  # seconds. zip archives (`doit package`) store mtimes in 2 seconds resolution
+
+
+def matrix_index_filename(filename: Union[str, Path]) -> Path:
+    return Path(filename).with_suffix('.json')
+
+
+def matrix_template_filename(filename: Union[str, Path]) -> Path:
+    return Path(filename).with_name(Path(filename).stem + '_template.npz')
+
+
+def file_index(filenames: List[Union[str, Path]]) -> dict:
+    return {
+        'ids': [Path(fn).stem for fn in filenames],
+        'filenames': [Path(fn).name for fn in filenames],
+        'mtimes': [Path(fn).stat().st_mtime for fn in filenames],
+    }
+
+
+def is_index_outdated(index: dict, filenames: List[Union[str, Path]]) -> bool:
+    '''
+    Compare the index (`file_index`) with the current source meshes (names and mtimes)
+    '''
+    return len(changed_files(index, filenames)) > 0 or len(index['filenames']) != len(filenames)
+
+
+def changed_files(index: dict, filenames: List[Union[str, Path]]) -> List[str]:
+    '''
+    Names of the files in the index which are missing or modified in `filenames`
+    '''
+    current = dict(zip(*[file_index(filenames)[key] for key in ['filenames', 'mtimes']]))
+    return [
+        name
+        for name, mtime in zip(index['filenames'], index['mtimes'])
+        if name not in current or abs(current[name] - mtime) > MTIME_TOLERANCE
+    ]
+
+
+def merge_index(index: dict, new_index: dict) -> dict:
+    return {key: index[key] + new_index[key] for key in ['ids', 'filenames', 'mtimes']}
+
+
+def is_matrix_outdated(filename: Union[str, Path], filenames: List[Union[str, Path]]) -> bool:
+    '''
+    Check the stacked-shape matrix against the source meshes
+    '''
+    index_fn = matrix_index_filename(filename)
+    if not Path(filename).exists() or not index_fn.exists():
+        return True
+    with open(index_fn) as f:
+        return is_index_outdated(json.load(f), filenames)
+
+
+def read_model_index(filename: Union[str, Path]) -> dict:
+    with np.load(filename) as npz:
+        return json.loads(str(npz['index']))
+
+
+def is_model_outdated(filename: Union[str, Path], filenames: List[Union[str, Path]]) -> bool:
+    '''
+    Check the model file (`PCAStats.save`) against the source meshes
+    '''
+    if not Path(filename).exists():
+        return True
+    return is_index_outdated(read_model_index(filename), filenames)
+
+
+def template_mesh(mesh: vtkPolyData) -> vtkPolyData:
+    '''
+    Points and triangles of `mesh` without any other cells or data arrays (e.g. scalars of transformed meshes)
+    '''
+    from vtkmodules.vtkFiltersCore import vtkTriangleFilter
+
+    triangles = vtkTriangleFilter()
+    triangles.SetInputData(mesh)
+    triangles.PassVertsOff()
+    triangles.PassLinesOff()
+    triangles.Update()
+    points = vtk_to_numpy(mesh.GetPoints().GetData())
+    faces = vtk_to_numpy(triangles.GetOutput().GetPolys().GetConnectivityArray()).reshape(-1, 3)
+    return arrays_to_mesh(points, faces)
+
+
+def build_matrix(filenames: List[Union[str, Path]], output: Union[str, Path]):
+    '''
+    Stack point sets of the meshes into one contiguous float32 matrix (n_meshes x 3*n_points) saved as `.npy`.
+    Also writes an index (`<output>.json`) of IDs, source filenames and their mtimes,
+    and the first mesh as the topology template (`<output>_template.npz`).
+    Rows of unmodified meshes are copied from the existing matrix instead of reading the meshes.
+    '''
+    output = Path(output)
+    template = read_mesh(str(filenames[0]))
+    n_points = template.GetNumberOfPoints()
+
+    old_rows = {}  # name: row in the existing matrix
+    old_X = None
+    if Path(output).exists() and matrix_index_filename(output).exists():
+        with open(matrix_index_filename(output)) as f:
+            index = json.load(f)
+        old_X = np.load(output, mmap_mode='r')
+        if old_X.shape[1] == 3 * n_points:
+            changed = set(changed_files(index, filenames))
+            old_rows = {name: i for i, name in enumerate(index['filenames']) if name not in changed}
+
+    tmp_fn = output.with_name(output.stem + '.part.npy')
+    X = np.lib.format.open_memmap(tmp_fn, mode='w+', dtype=np.float32, shape=(len(filenames), 3 * n_points))
+    for i, fn in enumerate(filenames):
+        if Path(fn).name in old_rows:
+            X[i] = old_X[old_rows[Path(fn).name]]
+            continue
+        points = vtk_to_numpy(read_mesh(str(fn)).GetPoints().GetData())
+        if len(points) != n_points:
+            raise RuntimeError(f'Number of points mismatch: {fn} has {len(points)} points, expected {n_points}')
+        X[i] = points.ravel()
+    X.flush()
+    del X, old_X  # close files before replacing
+    tmp_fn.replace(output)
+
+    write_mesh(matrix_template_filename(output), template_mesh(template))
+    with open(matrix_index_filename(output), 'w') as f:
+        json.dump(file_index(filenames), f, indent=1)
+    logger.info(
+        'Stacked %d meshes (%d points, %d reused) into %s', len(filenames), n_points, len(old_rows), output
+    )
+
+
+MODEL_VERSION = 1
+GRAM_RATIO = 10  # `auto` solver uses the Gram matrix if n_features >= GRAM_RATIO * n_samples
+GRAM_BLOCK_SIZE = 8192  # number of columns processed at a time
+NORMAL_BASIS_MAX_MODES = 4  # (n + 1)(n + 2) / 2 point arrays for the quadratic normal basis
+
+Progress = Callable[[str, int, int], None]  # stage ('read' or 'fit'), done, total
+
+
+class DistanceStats(NamedTuple):
+    dists: np.ndarray  # n_samples x n_pairs
+    mean: np.ndarray  # n_pairs
+    std: np.ndarray  # n_pairs
+    z: np.ndarray  # n_samples x n_pairs. nan if std is 0
+
+
+def component_signs(components: np.ndarray) -> np.ndarray:
+    '''
+    Signs making the largest absolute value of each component (row) positive,
+    as sklearn's `svd_flip(u_based_decision=False)` used by `PCA`
+    '''
+    return np.sign(components[range(len(components)), np.abs(components).argmax(axis=1)])
+
+
+def gram_pca(X, n_components: Optional[int] = None, dtype=np.float64, progress: Optional[Progress] = None):
+    '''
+    PCA via eigendecomposition of the n_samples x n_samples centered Gram matrix. Fast when n_samples << n_features.
+    Columns are processed in blocks so that a (memory-mapped) X is read only twice.
+    n_components: Number of components. `n_samples - 1` (rank of the centered data) if None.
+    dtype: dtype to accumulate the Gram matrix in
+    progress: Called with the number of processed blocks
+    return: mean, components (n_components x n_features), explained_variance, coefs (n_samples x n_components)
+    '''
+    n_samples, n_features = X.shape
+    if n_components is None:
+        n_components = n_samples - 1
+    mean = X.mean(axis=0, dtype=np.float64)
+    blocks = [slice(start, start + GRAM_BLOCK_SIZE) for start in range(0, n_features, GRAM_BLOCK_SIZE)]
+
+    gram = np.zeros((n_samples, n_samples), dtype=dtype)
+    for i, block in enumerate(blocks):
+        centered = (X[:, block] - mean[block]).astype(dtype, copy=False)
+        gram += centered @ centered.T
+        if progress:
+            progress('fit', i + 1, 2 * len(blocks))
+    eigvals, eigvecs = np.linalg.eigh(gram.astype(np.float64))
+    order = np.argsort(eigvals)[::-1][:n_components]
+    eigvals = np.clip(eigvals[order], 0, None)
+    eigvecs = eigvecs[:, order]
+    singular_values = np.sqrt(eigvals)
+
+    components = np.empty((n_components, n_features), dtype=np.float64)
+    for i, block in enumerate(blocks):
+        centered = (X[:, block] - mean[block]).astype(dtype, copy=False)
+        components[:, block] = eigvecs.T @ centered
+        if progress:
+            progress('fit', len(blocks) + i + 1, 2 * len(blocks))
+    components /= np.maximum(singular_values, np.finfo(np.float64).tiny)[:, np.newaxis]
+    signs = component_signs(components)
+    components *= signs[:, np.newaxis]
+    return mean, components, eigvals / (n_samples - 1), eigvecs * (singular_values * signs)
+
+
 class PCAStats:
-    def __init__(self, X):
-        pca = PCA()
-        self.all_coefs = pca.fit_transform(X)
-        self.components = pca.components_.reshape(len(pca.components_), -1, 3)
-        self.mean = pca.mean_.reshape(-1, 3)
-        self.pca = pca
+    def __init__(self, mean: np.ndarray, components: np.ndarray, explained_variance: np.ndarray, all_coefs: np.ndarray):
+        '''
+        mean: n_points x 3
+        components: n_components x n_points x 3
+        explained_variance: n_components
+        all_coefs: n_samples x n_components
+        '''
+        self.mean = mean
+        self.components = components
+        self.explained_variance = explained_variance
+        self.all_coefs = all_coefs
+        self._points_cache: Dict[int, np.ndarray] = {}
+
+    @staticmethod
+    def _from_pca(pca, all_coefs: np.ndarray) -> 'PCAStats':
+        return PCAStats(
+            pca.mean_.reshape(-1, 3),
+            pca.components_.reshape(len(pca.components_), -1, 3),
+            pca.explained_variance_,
+            all_coefs,
+        )
 
     @staticmethod
-    def from_files(filenames: List[Union[str, Path]]) -> Tuple['PCAStats', vtkPolyData]:
+    def fit(
+        X,
+        n_components: Optional[int] = None,
+        svd_solver: str = 'auto',
+        gram_dtype=np.float64,
+        progress: Optional[Progress] = None,
+    ) -> 'PCAStats':
+        '''
+        X: n_samples x (3 * n_points)
+        n_components: Number of components to keep. All components if None.
+        svd_solver: `gram` (`gram_pca`) or `sklearn.decomposition.PCA`'s svd_solver. `randomized` or `arpack` with
+            small `n_components` is much faster than the full SVD. `auto` uses `gram` if n_samples << n_features.
+        gram_dtype: dtype to accumulate the Gram matrix in
+        progress: Called as fitting proceeds (per block with `gram`, otherwise only at the start and the end)
+        '''
+        n_samples, n_features = X.shape
+        if svd_solver == 'gram' or (svd_solver == 'auto' and n_features >= GRAM_RATIO * n_samples):
+            mean, components, explained_variance, all_coefs = gram_pca(X, n_components, gram_dtype, progress)
+            components = components.reshape(len(components), -1, 3)
+            return PCAStats(mean.reshape(-1, 3), components, explained_variance, all_coefs)
+        if progress:
+            progress('fit', 0, 1)
+        pca = PCA(n_components=n_components, svd_solver=svd_solver)
+        all_coefs = pca.fit_transform(X)
+        if progress:
+            progress('fit', 1, 1)
+        return PCAStats._from_pca(pca, all_coefs)
+
+    @staticmethod
+    def fit_incremental(make_batches: Callable[[], Iterator[np.ndarray]], n_components: int) -> 'PCAStats':
+        '''
+        Fit in bounded memory with IncrementalPCA.
+        make_batches: Returns a new generator of batches (n_batch_samples x (3 * n_points)). Called twice, for fitting
+            and for the coefficients. Every batch needs at least `n_components` samples except for the last one.
+        '''
+        from sklearn.decomposition import IncrementalPCA
+
+        pca = IncrementalPCA(n_components=n_components)
+        pending = None  # a too small batch is merged into the next one
+        for batch in make_batches():
+            batch = batch if pending is None else np.concatenate([pending, batch])
+            pending = None
+            if len(batch) < n_components:
+                pending = batch
+                continue
+            pca.partial_fit(batch)
+        if pending is not None:
+            pca.partial_fit(pending)
+        all_coefs = np.concatenate([pca.transform(batch) for batch in make_batches()])
+        return PCAStats._from_pca(pca, all_coefs)
+
+    def transform(self, points: np.ndarray) -> np.ndarray:
         '''
+        Project points (n_points x 3) onto the components
+        '''
+        n_components = len(self.components)
+        return self.components.reshape(n_components, -1) @ (points - self.mean).ravel()
+
+    def inverse_transform(self, coef: np.ndarray) -> np.ndarray:
+        '''
+        return: points (n_points x 3)
+        '''
+        n_components = len(self.components)
+        return self.mean + (coef @ self.components.reshape(n_components, -1)).reshape(-1, 3)
+
+    @staticmethod
+    def from_files(
+        filenames: List[Union[str, Path]],
+        progress: Optional[Progress] = None,
+        on_mean: Optional[Callable[[vtkPolyData], None]] = None,
+        **kwargs,
+    ) -> Tuple['PCAStats', vtkPolyData]:
+        '''
+        progress: Called after reading each file and while fitting
+        on_mean: Called with the average shape before fitting
+        kwargs: Passed to `fit`
         returns stats and average shape
         '''
-        polys = [read_mesh(str(fn)) for fn in filenames]
+        polys = []
+        for i, fn in enumerate(filenames):
+            polys.append(read_mesh(str(fn)))
+            if progress:
+                progress('read', i + 1, len(filenames))
         poly_points = [vtk_to_numpy(poly.GetPoints().GetData()).copy() for poly in polys]
 
         all_points = np.stack(poly_points)
@@ -29,14 +322,413 @@ class PCAStats:
         mean_poly = polys[0]
         mean_points = all_points.mean(axis=0)
         mean_poly.GetPoints().SetData(numpy_to_vtk(mean_points))
-        return PCAStats(all_data), calculate_normals(mean_poly)
+        mean_poly = calculate_normals(mean_poly)
+        if on_mean:
+            on_mean(mean_poly)
+        return PCAStats.fit(all_data, progress=progress, **kwargs), mean_poly
+
+    @staticmethod
+    def from_files_incremental(
+        filenames: List[Union[str, Path]], n_components: int, batch_size: int = 64
+    ) -> Tuple['PCAStats', vtkPolyData]:
+        '''
+        Fit with `fit_incremental` reading `batch_size` meshes at a time.
+        returns stats and average shape
+        '''
+
+        def make_batches():
+            for i in range(0, len(filenames), batch_size):
+                polys = [read_mesh(str(fn)) for fn in filenames[i : i + batch_size]]
+                yield np.stack([vtk_to_numpy(poly.GetPoints().GetData()).ravel() for poly in polys])
+
+        stats = PCAStats.fit_incremental(make_batches, n_components)
+        mean_poly = read_mesh(str(filenames[0]))
+        mean_poly.GetPoints().SetData(numpy_to_vtk(stats.mean.copy()))
+        return stats, calculate_normals(mean_poly)
+
+    @staticmethod
+    def from_matrix(
+        filename: Union[str, Path],
+        progress: Optional[Progress] = None,
+        on_mean: Optional[Callable[[vtkPolyData], None]] = None,
+        **kwargs,
+    ) -> Tuple['PCAStats', vtkPolyData]:
+        '''
+        Load the stacked-shape matrix written by `build_matrix` (memory-mapped).
+        progress: Called while fitting
+        on_mean: Called with the average shape before fitting
+        kwargs: Passed to `fit`
+        returns stats and average shape
+        '''
+        X = np.load(filename, mmap_mode='r')
+        mean_poly = read_mesh(matrix_template_filename(filename))
+        mean_points = X.mean(axis=0, dtype=np.float64).reshape(-1, 3)
+        mean_poly.GetPoints().SetData(numpy_to_vtk(mean_points))
+        mean_poly = calculate_normals(mean_poly)
+        if on_mean:
+            on_mean(mean_poly)
+        return PCAStats.fit(X, progress=progress, **kwargs), mean_poly
+
+    def save(self, filename: Union[str, Path], mean_poly: vtkPolyData, index: dict):
+        '''
+        Save model with the mean mesh topology and the index (`file_index`) of the source meshes into one npz file.
+        Components are stored in float32.
+        '''
+        filename = Path(filename)
+        tmp_fn = filename.with_name(filename.name + '.part.npz')
+        np.savez(
+            tmp_fn,
+            version=np.array(MODEL_VERSION),
+            mean=self.mean,
+            components=self.components.astype(np.float32),
+            explained_variance=self.explained_variance,
+            all_coefs=self.all_coefs,
+            faces=vtk_to_numpy(mean_poly.GetPolys().GetConnectivityArray()).reshape(-1, 3).astype(np.int32),
+            index=np.array(json.dumps(index)),
+        )
+        tmp_fn.replace(filename)
+
+    @staticmethod
+    def from_model(filename: Union[str, Path]) -> Tuple['PCAStats', vtkPolyData]:
+        '''
+        Load model saved by `save`.
+        returns stats and average shape
+        '''
+        with np.load(filename) as npz:
+            version = int(npz['version'])
+            if version != MODEL_VERSION:
+                raise RuntimeError(f'Unsupported model version {version} (expected {MODEL_VERSION}): {filename}')
+            stats = PCAStats(npz['mean'], npz['components'], npz['explained_variance'], npz['all_coefs'])
+            faces = npz['faces']
+        return stats, calculate_normals(arrays_to_mesh(stats.mean.copy(), faces))
+
+    def update(self, X) -> 'PCAStats':
+        '''
+        Add samples without refitting (incremental SVD with mean update).
+        Coefficients of the existing samples are updated from the model alone, so the original data is not needed.
+        The update is exact if the model keeps all the components (`n_samples - 1`).
+        A truncated model (fewer components) keeps its number of components and the result is approximate:
+        variance outside of the kept components is lost, so the update differs from refitting with all the samples.
+        X: n_new_samples x (3 * n_points)
+        return: updated stats. Coefficients of the new samples are appended to `all_coefs`.
+        '''
+        n_old, n_new = len(self.all_coefs), len(X)
+        n_components = len(self.components)
+        truncated = n_components < n_old - 1
+        V = self.components.reshape(n_components, -1).astype(np.float64)
+        S = np.sqrt(self.explained_variance * (n_old - 1))
+        old_mean = self.mean.ravel()
+        new_mean_x = X.mean(axis=0, dtype=np.float64)
+        mean = (n_old * old_mean + n_new * new_mean_x) / (n_old + n_new)
+
+        # rows to decompose: [S V; X - mean(X); mean correction]. V is orthonormal.
+        C = np.vstack([X - new_mean_x, np.sqrt(n_old * n_new / (n_old + n_new)) * (old_mean - new_mean_x)])
+        SVC = S[:, np.newaxis] * (V @ C.T)
+        gram = np.block([[np.diag(S**2), SVC], [SVC.T, C @ C.T]])
+        eigvals, eigvecs = np.linalg.eigh(gram)
+        n_keep = n_components if truncated else min(n_components + n_new, n_old + n_new - 1)
+        order = np.argsort(eigvals)[::-1][:n_keep]
+        eigvals = np.clip(eigvals[order], 0, None)
+        eigvecs = eigvecs[:, order]
+        singular_values = np.sqrt(eigvals)
+        components = (eigvecs[:n_components] * S[:, np.newaxis]).T @ V + eigvecs[n_components:].T @ C
+        components /= np.maximum(singular_values, np.finfo(np.float64).tiny)[:, np.newaxis]
+
+        old_coefs = self.all_coefs @ (V @ components.T) + (old_mean - mean) @ components.T
+        new_coefs = (X - mean) @ components.T
+        all_coefs = np.vstack([old_coefs, new_coefs])
+        signs = component_signs(components)
+        return PCAStats(
+            mean.reshape(-1, 3),
+            (components * signs[:, np.newaxis]).reshape(n_keep, -1, 3),
+            eigvals / (n_old + n_new - 1),
+            all_coefs * signs,
+        )
+
+    def get_points_batch(self, pids: Sequence[int]) -> np.ndarray:
+        '''
+        Reconstruct points of all samples in one pass. Reconstructed points are cached.
+        return: n_samples x len(pids) x 3
+        '''
+        pids = [int(pid) for pid in pids]
+        missing = sorted(set(pids).difference(self._points_cache))
+        if len(missing) > 0:
+            n_components = len(self.components)
+            deviation = self.all_coefs @ self.components[:, missing, :].reshape(n_components, -1)
+            pts = self.mean[missing] + deviation.reshape(len(self.all_coefs), len(missing), 3)
+            for i, pid in enumerate(missing):
+                self._points_cache[pid] = pts[:, i]
+        return np.stack([self._points_cache[pid] for pid in pids], axis=1)
 
     def get_points(self, pid: int):
-        pts = self.mean[pid] + self.all_coefs @ self.components[:, pid, :]
-        return pts
+        return self.get_points_batch([pid])[:, 0]
+
+    def dists_pairs(self, pairs: Sequence[Tuple[int, int]]) -> np.ndarray:
+        '''
+        Distances between pairs of points for all samples
+        return: n_samples x n_pairs
+        '''
+        pairs = np.asarray(pairs, dtype=int).reshape(-1, 2)
+        pids, inverse = np.unique(pairs, return_inverse=True)
+        inverse = inverse.reshape(pairs.shape)
+        pts = self.get_points_batch(pids)
+        return np.linalg.norm(pts[:, inverse[:, 0]] - pts[:, inverse[:, 1]], axis=2)
+
+    def distance_stats(self, pairs: Sequence[Tuple[int, int]]) -> DistanceStats:
+        '''
+        Distances between pairs of points for all samples with mean, std and z-scores per pair
+        '''
+        dists = self.dists_pairs(pairs)
+        mean = dists.mean(axis=0)
+        std = dists.std(axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            z = np.where(std > 0, (dists - mean) / std, np.nan)
+        return DistanceStats(dists, mean, std, z)
 
     def dists_between(self, pid1: int, pid2: int) -> np.ndarray:
-        p1 = self.get_points(pid1)
-        p2 = self.get_points(pid2)
-        diff = p1 - p2
-        return np.linalg.norm(diff, axis=1)
+        return self.dists_pairs([(pid1, pid2)])[:, 0]
+
+    def subset(self, pids: Sequence[int]) -> 'PCAStats':
+        '''
+        Model of the subset of points (e.g. points of a decimated mesh). Coefficients are shared.
+        '''
+        pids = np.asarray(pids)
+        return PCAStats(self.mean[pids], self.components[:, pids], self.explained_variance, self.all_coefs)
+
+
+class MorphEngine:
+    '''
+    Morph shape in place for interactive display.
+    Points are `base + coef[:n_modes] @ basis`. `basis` holds the displayed modes in float32 and `base` is the mean
+    plus the contribution of the other modes, so moving a displayed mode costs one small GEMV and no projection.
+
+    Normals (area weighted) are optionally updated as well. Face normals are quadratic in the displayed coefficients
+    since edges are linear in them, so the per-point sums of the quadratic terms are precomputed for the current
+    `base` and moving a displayed mode costs one more GEMV and a normalization.
+    Changing `base` (morphing) falls back to face normals summed by the sparse vertex-face incidence matrix.
+    '''
+
+    def __init__(
+        self,
+        stats: PCAStats,
+        points: np.ndarray,
+        n_modes: int,
+        faces: Optional[np.ndarray] = None,
+        normals: Optional[np.ndarray] = None,
+    ):
+        '''
+        points: Buffer (n_points x 3) to update in place, e.g. numpy view of vtkPoints
+        n_modes: Number of displayed modes
+        faces: Triangles (n_faces x 3) to update `normals`
+        normals: Buffer (n_points x 3, float32) to update in place
+        '''
+        self.stats = stats
+        self.points = points.reshape(-1)
+        if not np.shares_memory(self.points, points):
+            raise RuntimeError('Points buffer needs to be contiguous')
+        self.n_modes = n_modes
+        self.basis = np.ascontiguousarray(stats.components[:n_modes].reshape(n_modes, -1), dtype=np.float32)
+        self.coef = np.zeros(len(stats.components))
+        self.base = stats.mean.ravel().astype(np.float32)
+        self._deviation = np.empty_like(self.base)
+        self._case_bases: Dict[Optional[int], np.ndarray] = {}
+        self.faces = faces
+        self.normals = normals
+        if normals is not None:
+            if faces is None:
+                raise RuntimeError('faces are required to update normals')
+            self.incidence = vertex_face_incidence(faces, len(points))
+        self._normal_basis: Optional[np.ndarray] = None
+        self._update()
+
+    def _build_normal_basis(self):
+        '''
+        Sums of face normal terms around points for the current `base`. Row order matches `_monomials`.
+        '''
+
+        def edges(flat):
+            points = flat.reshape(-1, 3)
+            p0 = points[self.faces[:, 0]]
+            return points[self.faces[:, 1]] - p0, points[self.faces[:, 2]] - p0
+
+        base_edges = edges(self.base)
+        mode_edges = [edges(mode) for mode in self.basis]
+        terms = [np.cross(*base_edges)]
+        for a1, a2 in mode_edges:
+            terms.append(np.cross(base_edges[0], a2) + np.cross(a1, base_edges[1]))
+        for i, (a1, a2) in enumerate(mode_edges):
+            for b1, b2 in mode_edges[i:]:
+                if a1 is b1:
+                    terms.append(np.cross(a1, a2))
+                else:
+                    terms.append(np.cross(a1, b2) + np.cross(b1, a2))
+        self._normal_basis = np.stack([(self.incidence @ term).ravel() for term in terms])
+
+    def _monomials(self) -> np.ndarray:
+        c = self.coef[: self.n_modes]
+        return np.concatenate([[1], c, [c[i] * c[j] for i in range(len(c)) for j in range(i, len(c))]]).astype(
+            np.float32
+        )
+
+    def _update_normals(self):
+        if self.normals is None:
+            return
+        if self._normal_basis is None:
+            points = self.points.reshape(-1, 3)
+            self.normals[:] = self.incidence @ face_normals(points, self.faces)
+        else:
+            np.matmul(self._monomials(), self._normal_basis, out=self.normals.reshape(-1))
+        normalize_rows(self.normals)
+
+    def _base_of(self, coef: np.ndarray) -> np.ndarray:
+        rest = self.stats.components[self.n_modes :].reshape(len(self.stats.components) - self.n_modes, -1)
+        return (self.stats.mean.ravel() + coef[self.n_modes :] @ rest).astype(np.float32)
+
+    def _case_coef(self, case: Optional[int]) -> np.ndarray:
+        return np.zeros(len(self.stats.components)) if case is None else self.stats.all_coefs[case]
+
+    def _update(self):
+        np.matmul(self.coef[: self.n_modes].astype(np.float32), self.basis, out=self._deviation)
+        np.add(self.base, self._deviation, out=self.points)
+        self._update_normals()
+
+    def set_mode(self, index: int, value: float):
+        '''
+        Set coefficient of one of the displayed modes
+        '''
+        self.coef[index] = value
+        if self.normals is not None and self._normal_basis is None and self.n_modes <= NORMAL_BASIS_MAX_MODES:
+            self._build_normal_basis()
+        self._update()
+
+    def set_coef(self, coef: np.ndarray):
+        '''
+        Set all the coefficients. Costs a full reconstruction.
+        '''
+        self.coef = np.array(coef, dtype=np.float64)
+        self.base = self._base_of(self.coef)
+        self._normal_basis = None
+        self._update()
+
+    def morph(self, case1: Optional[int], case2: Optional[int], value: float):
+        '''
+        Interpolate between two cases (None for the mean shape).
+        Bases of the two cases are cached so that moving `value` costs only linear combinations.
+        '''
+        self._case_bases = {case: base for case, base in self._case_bases.items() if case in (case1, case2)}
+        for case in (case1, case2):
+            if case not in self._case_bases:
+                self._case_bases[case] = self._base_of(self._case_coef(case))
+        np.multiply(self._case_bases[case1], 1 - value, out=self.base)
+        self.base += np.float32(value) * self._case_bases[case2]
+        self.coef = (1 - value) * self._case_coef(case1) + value * self._case_coef(case2)
+        self._normal_basis = None
+        self._update()
+
+
+def append_model(filename: Union[str, Path], index: dict, filenames: List[Union[str, Path]], matrix=None) -> int:
+    '''
+    Add meshes which are not in the model (`index`) to the model file
+    '''
+    new_filenames = [fn for fn in filenames if Path(fn).name not in set(index['filenames'])]
+    stats, mean_poly = PCAStats.from_model(filename)
+    if matrix and not is_matrix_outdated(matrix, filenames):
+        with open(matrix_index_filename(matrix)) as f:
+            rows = {name: i for i, name in enumerate(json.load(f)['filenames'])}
+        X = np.load(matrix, mmap_mode='r')[[rows[Path(fn).name] for fn in new_filenames]]
+    else:
+        X = np.stack([vtk_to_numpy(read_mesh(str(fn)).GetPoints().GetData()).ravel() for fn in new_filenames])
+    stats = stats.update(X)
+    stats.save(filename, mean_poly, merge_index(index, file_index(new_filenames)))
+    logger.info('Added %d meshes to %s (%d meshes)', len(new_filenames), filename, len(stats.all_coefs))
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Statistical shape model.')
+    subparsers = parser.add_subparsers()
+    sub_matrix = subparsers.add_parser('build_matrix', help='Stack meshes into a memory-mappable matrix')
+    sub_matrix.add_argument('input', help='Input directory of registered meshes (.vtp)')
+    sub_matrix.add_argument('output', help='Output filename (.npy)')
+    sub_matrix.add_argument('-f', '--force', help='Build even if the matrix is up to date', action='store_true')
+
+    def command_build_matrix(args):
+        filenames = sorted(Path(args.input).glob('*.vtp'))
+        if len(filenames) == 0:
+            logger.error('No mesh was found in %s', args.input)
+            return 1
+        if not args.force and not is_matrix_outdated(args.output, filenames):
+            logger.info('%s is up to date', args.output)
+            return 0
+        build_matrix(filenames, args.output)
+        return 0
+
+    sub_matrix.set_defaults(handler=command_build_matrix)
+
+    sub_model = subparsers.add_parser('build_model', help='Fit and save PCA model')
+    sub_model.add_argument('input', help='Input directory of registered meshes (.vtp)')
+    sub_model.add_argument('output', help='Output model filename (.npz)')
+    sub_model.add_argument('--matrix', help='Stacked-shape matrix (.npy) to fit if it is up to date')
+    sub_model.add_argument('-n', '--n_components', help='Number of components. default: all', type=int)
+    sub_model.add_argument(
+        '--svd_solver',
+        help='SVD solver. default: %(default)s',
+        choices=['auto', 'gram', 'full', 'randomized', 'arpack'],
+        default='auto',
+    )
+    sub_model.add_argument('--float32', help='Accumulate the Gram matrix in float32', action='store_true')
+    sub_model.add_argument(
+        '--batch_size', help='Fit incrementally reading this many meshes at a time. Requires --n_components', type=int
+    )
+    sub_model.add_argument(
+        '--append',
+        help='Add new meshes to the existing model (incremental SVD) instead of refitting. '
+        'Refit if any mesh in the model was modified or removed',
+        action='store_true',
+    )
+    sub_model.add_argument('-f', '--force', help='Build even if the model is up to date', action='store_true')
+
+    def command_build_model(args):
+        filenames = sorted(Path(args.input).glob('*.vtp'))
+        if len(filenames) == 0:
+            logger.error('No mesh was found in %s', args.input)
+            return 1
+        if not args.force and not is_model_outdated(args.output, filenames):
+            logger.info('%s is up to date', args.output)
+            return 0
+        if args.append and not args.force and Path(args.output).exists():
+            index = read_model_index(args.output)
+            changed = changed_files(index, filenames)
+            if len(changed) == 0:
+                return append_model(args.output, index, filenames, args.matrix)
+            logger.info('Refit model. %d meshes were modified or removed: %s', len(changed), ', '.join(changed[:5]))
+        fit_args = {
+            'n_components': args.n_components,
+            'svd_solver': args.svd_solver,
+            'gram_dtype': np.float32 if args.float32 else np.float64,
+        }
+        if args.batch_size:
+            if args.n_components is None:
+                logger.error('--batch_size requires --n_components')
+                return 1
+            stats, mean_poly = PCAStats.from_files_incremental(filenames, args.n_components, args.batch_size)
+        elif args.matrix and not is_matrix_outdated(args.matrix, filenames):
+            stats, mean_poly = PCAStats.from_matrix(args.matrix, **fit_args)
+        else:
+            stats, mean_poly = PCAStats.from_files(filenames, **fit_args)
+        stats.save(args.output, mean_poly, file_index(filenames))
+        logger.info('Saved model of %d meshes into %s', len(filenames), args.output)
+        return 0
+
+    sub_model.set_defaults(handler=command_build_model)
+    args = parser.parse_args()
+
+    if not hasattr(args, 'handler'):
+        print('No command was specified.')
+        parser.print_help()
+        sys.exit(1)
+    return args.handler(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
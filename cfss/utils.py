@@ -1,41 +1,133 @@
 import argparse
+import hashlib
+import os
 import shutil
 import sys
+import zipfile
 from pathlib import Path
-from typing import Union
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Sequence, Tuple, Union
 
-import cc3d
 import logzero
 import numpy as np
 from logzero import logger
-from scipy import ndimage
-from szkmipy import boundingbox as bb
-from szkmipy import mhd
-from vtkmodules.vtkCommonDataModel import vtkPolyData
-from vtkmodules.vtkFiltersCore import vtkPolyDataNormals
-from vtkmodules.vtkIOLegacy import vtkDataWriter, vtkPolyDataReader, vtkPolyDataWriter
-from vtkmodules.vtkIOPLY import vtkPLYWriter
-from vtkmodules.vtkIOXML import vtkXMLPolyDataReader, vtkXMLPolyDataWriter
 
 
-def read_mesh(filename: Union[str, Path]) -> vtkPolyData:
+# heavy modules (vtk, scipy, cc3d, szkmipy) are imported in functions to keep startup fast
+if TYPE_CHECKING:
+    from vtkmodules.vtkCommonDataModel import vtkPolyData
+
+
+MESH_SIDECAR_SUFFIX = '.npz'  # array cache written next to .vtk/.vtp meshes (e.g. mesh.vtk.npz)
+
+
+def mesh_to_arrays(mesh: 'vtkPolyData') -> Optional[Dict[str, np.ndarray]]:
+    '''
+    Convert triangle mesh into points (float32), faces (int32) and optional point normals (float32).
+    return None if the mesh can not be represented by these arrays (e.g. non-triangle cells, extra point data).
+    '''
+    from vtkmodules.util.numpy_support import vtk_to_numpy
+
+    polys = mesh.GetPolys()
+    normals = mesh.GetPointData().GetNormals()
+    n_extra = mesh.GetPointData().GetNumberOfArrays() - (normals is not None) + mesh.GetCellData().GetNumberOfArrays()
+    if mesh.GetNumberOfPoints() == 0 or n_extra > 0 or mesh.GetNumberOfCells() != polys.GetNumberOfCells():
+        return None
+    if polys.GetNumberOfCells() > 0 and polys.IsHomogeneous() != 3:
+        return None
+    arrays = {
+        'points': vtk_to_numpy(mesh.GetPoints().GetData()).astype(np.float32, copy=False),
+        'faces': vtk_to_numpy(polys.GetConnectivityArray()).astype(np.int32, copy=False).reshape(-1, 3),
+    }
+    if normals is not None:
+        arrays['normals'] = vtk_to_numpy(normals).astype(np.float32, copy=False)
+    return arrays
+
+
+def arrays_to_mesh(points: np.ndarray, faces: np.ndarray, normals: Optional[np.ndarray] = None) -> 'vtkPolyData':
+    '''
+    Wrap arrays into vtkPolyData without copying points and normals.
+    '''
+    from vtkmodules.util.numpy_support import numpy_to_vtk
+    from vtkmodules.vtkCommonCore import vtkPoints
+    from vtkmodules.vtkCommonDataModel import vtkCellArray, vtkPolyData
+
+    vtk_points = vtkPoints()
+    vtk_points.SetData(numpy_to_vtk(np.ascontiguousarray(points)))
+    offsets = np.arange(0, faces.size + 1, 3, dtype=faces.dtype)
+    cells = vtkCellArray()
+    cells.SetData(numpy_to_vtk(offsets), numpy_to_vtk(np.ascontiguousarray(faces).ravel()))
+    mesh = vtkPolyData()
+    mesh.SetPoints(vtk_points)
+    mesh.SetPolys(cells)
+    if normals is not None:
+        vtk_normals = numpy_to_vtk(np.ascontiguousarray(normals))
+        vtk_normals.SetName('Normals')
+        mesh.GetPointData().SetNormals(vtk_normals)
+    return mesh
+
+
+def read_npz_mesh(filename: Union[str, Path]) -> 'vtkPolyData':
+    with np.load(filename) as npz:
+        return arrays_to_mesh(**{key: npz[key] for key in npz.files})
+
+
+def _save_npz(filename: Path, arrays: Dict[str, np.ndarray], compress: bool):
+    # write to a temporary file first so that readers never see a partial file
+    tmp_filename = filename.with_name(filename.name + '.part.npz')
+    (np.savez_compressed if compress else np.savez)(tmp_filename, **arrays)
+    tmp_filename.replace(filename)
+
+
+def write_npz_mesh(filename: Union[str, Path], mesh: 'vtkPolyData', compress: bool = False):
+    arrays = mesh_to_arrays(mesh)
+    if arrays is None:
+        raise RuntimeError(f'Mesh can not be written in npz format: {filename}')
+    _save_npz(Path(filename), arrays, compress)
+
+
+def sidecar_filename(filename: Union[str, Path]) -> Path:
+    return Path(str(filename) + MESH_SIDECAR_SUFFIX)
+
+
+def read_mesh(filename: Union[str, Path]) -> 'vtkPolyData':
+    '''
+    Read mesh. Up-to-date sidecar array cache (`<filename>.npz`) is used instead of .vtk/.vtp if available.
+    '''
+    from vtkmodules.vtkIOLegacy import vtkPolyDataReader
+    from vtkmodules.vtkIOXML import vtkXMLPolyDataReader
+
     filename = Path(filename)
     ext = filename.suffix
-    ext = Path(filename).suffix
+    if ext == '.npz':
+        return read_npz_mesh(filename)
     if ext == '.vtk':
         reader = vtkPolyDataReader()
     elif ext in ['.vtp', '.xml']:
         reader = vtkXMLPolyDataReader()
     else:
         raise RuntimeError(f'Invalid file format: {filename}')
+    sidecar = sidecar_filename(filename)
+    if sidecar.exists() and sidecar.stat().st_mtime >= filename.stat().st_mtime:
+        return read_npz_mesh(sidecar)
     reader.SetFileName(str(filename))
     reader.Update()
     return reader.GetOutput()
 
 
-def write_mesh(filename: Union[str, Path], mesh):
+def write_mesh(filename: Union[str, Path], mesh, sidecar: bool = True, compress: bool = False):
+    '''
+    sidecar: Write array cache (`<filename>.npz`) next to .vtk/.vtp files for faster reading.
+    compress: Compress .npz file (zlib).
+    '''
+    from vtkmodules.vtkIOLegacy import vtkDataWriter, vtkPolyDataWriter
+    from vtkmodules.vtkIOPLY import vtkPLYWriter
+    from vtkmodules.vtkIOXML import vtkXMLPolyDataWriter
+
     filename = Path(filename)
     ext = filename.suffix
+    if ext == '.npz':
+        write_npz_mesh(filename, mesh, compress)
+        return
     if ext == '.vtk':
         writer = vtkPolyDataWriter()
         writer.SetFileVersion(vtkDataWriter.VTK_LEGACY_READER_VERSION_4_2)  # for irtk input
@@ -49,8 +141,17 @@ def write_mesh(filename: Union[str, Path], mesh):
     writer.SetInputData(mesh)
     writer.Update()
 
+    if ext in ['.vtk', '.vtp', '.xml']:
+        arrays = mesh_to_arrays(mesh) if sidecar else None
+        if arrays is None:
+            sidecar_filename(filename).unlink(missing_ok=True)  # stale cache
+        else:
+            _save_npz(sidecar_filename(filename), arrays, compress)
+
+
+def calculate_normals(mesh: 'vtkPolyData') -> 'vtkPolyData':
+    from vtkmodules.vtkFiltersCore import vtkPolyDataNormals
 
-def calculate_normals(mesh: vtkPolyData) -> vtkPolyData:
     normals = vtkPolyDataNormals()
     normals.SetInputData(mesh)
     normals.SplittingOff()
@@ -58,36 +159,155 @@ def calculate_normals(mesh: vtkPolyData) -> vtkPolyData:
     return normals.GetOutput()
 
 
-def segment_body(vol):
-    iterations = 3
-    body = vol > 0
-    bbox = bb.bbox(body)
-    body = bb.crop(body, bbox, margin=iterations + 1)
-    logger.debug('closing')
+def decimate(mesh: 'vtkPolyData', n_points: int) -> Tuple['vtkPolyData', np.ndarray]:
+    '''
+    Decimate triangle mesh to about `n_points` points (vtkDecimatePro). Remaining points are not moved.
+    return: decimated mesh and indices of its points in `mesh`
+    '''
+    from scipy.spatial import cKDTree
+    from vtkmodules.util.numpy_support import vtk_to_numpy
+    from vtkmodules.vtkFiltersCore import vtkDecimatePro
+
+    decimate = vtkDecimatePro()
+    decimate.SetInputData(mesh)
+    decimate.SetTargetReduction(max(0.0, 1 - n_points / mesh.GetNumberOfPoints()))
+    decimate.PreserveTopologyOn()
+    decimate.Update()
+    decimated = decimate.GetOutput()
+    points = vtk_to_numpy(mesh.GetPoints().GetData())
+    dists, indices = cKDTree(points).query(vtk_to_numpy(decimated.GetPoints().GetData()))
+    if dists.max() > 1e-4:
+        raise RuntimeError('Decimated points do not match the original points')
+    return decimated, indices
+
+
+def vertex_face_incidence(faces: np.ndarray, n_points: int):
+    '''
+    Sparse (CSR) n_points x n_faces matrix of ones where the point is a vertex of the face
+    '''
+    from scipy import sparse
+
+    face_ids = np.repeat(np.arange(len(faces)), faces.shape[1])
+    ones = np.ones(faces.size, dtype=np.float32)
+    return sparse.csr_matrix((ones, (faces.ravel(), face_ids)), shape=(n_points, len(faces)))
+
+
+def face_normals(points: np.ndarray, faces: np.ndarray) -> np.ndarray:
+    '''
+    Area weighted face normals: the length is twice the area of the face.
+    '''
+    return np.cross(points[faces[:, 1]] - points[faces[:, 0]], points[faces[:, 2]] - points[faces[:, 0]])
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), np.finfo(vectors.dtype).tiny)
+    return vectors
+
+
+def iter_slabs(depth: int, slab_size: int, halo: int):
+    '''
+    Yield (outer, core) slices that tile `range(depth)` with z-slabs of `slab_size`.
+    `outer` extends `core` by `halo` slices on both sides (clipped to the volume).
+    '''
+    for start in range(0, depth, slab_size):
+        stop = min(start + slab_size, depth)
+        yield slice(max(start - halo, 0), min(stop + halo, depth)), slice(start, stop)
+
+
+def apply_slabs(func, src: np.ndarray, slab_size: Optional[int], halo: int, n_jobs: int = 1, dtype=bool):
+    '''
+    Apply `func` to overlapping z-slabs of `src` and stitch the cores of the results.
+    The result is identical to `func(src)` as long as `halo` covers the reach of `func` along z.
+    Slabs are processed in threads since scipy.ndimage releases the GIL.
+    '''
+    from joblib import Parallel, delayed
+
+    if slab_size is None or slab_size >= len(src):
+        return func(src)
+
+    dst = np.empty(src.shape, dtype=dtype)
+
+    def do(outer, core):
+        result = func(src[outer])
+        dst[core] = result[core.start - outer.start : core.stop - outer.start]
+
+    Parallel(n_jobs=n_jobs, prefer='threads')(
+        delayed(do)(outer, core) for outer, core in iter_slabs(len(src), slab_size, halo)
+    )
+    return dst
+
+
+def _close_and_fill(body):
+    from scipy import ndimage
+
     body = ndimage.binary_closing(body, structure=np.ones((3, 3, 3)))
-    logger.debug('fill holes')
     # body = ndimage.binary_fill_holes(body, structure=np.ones((1, 3, 3)))
     for i in range(len(body)):
         ndimage.binary_fill_holes(body[i], structure=np.ones((3, 3)), output=body[i])
+    return body
+
+
+def segment_body(vol, slab_size: Optional[int] = None, n_jobs: int = 1):
+    '''
+    Segment body (largest connected component) from CT image.
+
+    slab_size: Process morphology in z-slabs of this many slices to bound memory usage. Whole volume at once by default.
+    n_jobs: Number of threads for slab processing.
+
+    return: body mask and dilated body mask
+    '''
+    import cc3d
+    from scipy import ndimage
+    from szkmipy import boundingbox as bb
+
+    iterations = 3
+    body = vol > 0
+    bbox = bb.bbox(body)
+    body = bb.crop(body, bbox, margin=iterations + 1)
+    logger.debug('closing and fill holes')
+    # closing reaches 2 slices (dilation + erosion). hole filling is done slice by slice.
+    body = apply_slabs(_close_and_fill, body, slab_size, halo=2, n_jobs=n_jobs)
     logger.debug('largest')
     labels_out = cc3d.largest_k(body, k=1)
     logger.debug('dilation')
-    dilated = ndimage.binary_dilation(labels_out, structure=np.ones((3, 3, 3)), iterations=iterations)
+
+    def dilate(labels):
+        return ndimage.binary_dilation(labels, structure=np.ones((3, 3, 3)), iterations=iterations)
+
+    dilated = apply_slabs(dilate, labels_out, slab_size, halo=iterations, n_jobs=n_jobs)
+    del labels_out
     body = bb.uncrop(body, vol.shape, bbox, margin=iterations + 1, constant_values=0)
     dilated = bb.uncrop(dilated, vol.shape, bbox, margin=iterations + 1, constant_values=0)
     return body, dilated
 
 
-def remove_bed(input_filename, output=None, mask=None):
+def remove_bed(input_filename, output=None, mask=None, slab_size: Optional[int] = None, n_jobs: int = 1):
+    from szkmipy import boundingbox as bb
+    from szkmipy import mhd
+
     logger.debug('Load input image')
-    vol, h = mhd.read(input_filename)
+    vol, h = read_image(input_filename)
     if vol.dtype != np.int16:
         logger.info('Skip (not int16 image): %s', input_filename)
         return
-    body, dilated = segment_body(vol)
+    body, dilated = segment_body(vol, slab_size, n_jobs)
     min_value, max_value = -1000, 2000
-    vol = np.clip(vol, min_value, max_value)
-    vol[dilated == 0] = min_value
+    if slab_size is None:
+        # only the bounding box of the dilated body is read (again) from the (memory-mapped) input
+        bbox = bb.bbox(dilated)
+        cropped = np.clip(bb.crop(vol, bbox), min_value, max_value)
+        cropped[bb.crop(dilated, bbox) == 0] = min_value
+        vol = bb.uncrop(cropped, vol.shape, bbox, constant_values=min_value)
+    else:
+        if not mask:
+            del body
+        # temporaries are bounded to a slab. only the slices of the dilated body are read (again).
+        output_vol = np.full(vol.shape, min_value, dtype=vol.dtype)
+        slices = np.flatnonzero(dilated.any(axis=(1, 2)))
+        for start in range(slices[0], slices[-1] + 1, slab_size):
+            slab = slice(start, min(start + slab_size, slices[-1] + 1))
+            output_vol[slab] = np.where(dilated[slab], np.clip(vol[slab], min_value, max_value), min_value)
+        vol = output_vol
     if mask:
         logger.debug('Save mask')
         mhd.write(mask, body.astype(np.uint8), h)
@@ -96,6 +316,269 @@ def remove_bed(input_filename, output=None, mask=None):
         mhd.write(output, vol, h)
 
 
+def rss_bytes() -> Optional[int]:
+    '''
+    Current resident set size of the process in bytes. None if it's unavailable (e.g. windows).
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+class PeakRSS:
+    '''
+    Peak resident set size while in the context, sampled in a thread every `interval` seconds.
+    Unlike `ru_maxrss`, the peak is not carried over from earlier tasks run by the same (pooled) worker process.
+    `start_mb` and `peak_mb` are None if RSS is unavailable.
+    '''
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.start_mb: Optional[float] = None
+        self.peak_mb: Optional[float] = None
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak_mb = max(self.peak_mb, rss_bytes() / 2**20)
+
+    def __enter__(self) -> 'PeakRSS':
+        import threading
+
+        rss = rss_bytes()
+        if rss is not None:
+            self.start_mb = self.peak_mb = rss / 2**20
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.start_mb is not None:
+            self._stop.set()
+            self._thread.join()
+            self.peak_mb = max(self.peak_mb, rss_bytes() / 2**20)
+
+
+# https://itk.org/Wiki/ITK/MetaIO/Documentation
+MET_TYPES = {
+    'MET_CHAR': np.int8,
+    'MET_UCHAR': np.uint8,
+    'MET_SHORT': np.int16,
+    'MET_USHORT': np.uint16,
+    'MET_INT': np.int32,
+    'MET_UINT': np.uint32,
+    'MET_LONG': np.int32,
+    'MET_ULONG': np.uint32,
+    'MET_LONG_LONG': np.int64,
+    'MET_ULONG_LONG': np.uint64,
+    'MET_FLOAT': np.float32,
+    'MET_DOUBLE': np.float64,
+}
+# numeric header fields describing geometry (i.e. not data layout)
+GEOMETRY_FIELDS = ['Offset', 'ElementSpacing', 'TransformMatrix', 'CenterOfRotation']
+
+
+def read_mha_header(filename: Union[str, Path]) -> Dict[str, str]:
+    '''
+    Read header of mha/mhd file without loading image data.
+    '''
+    header = {}
+    with open(filename, 'rb') as f:
+        for line in f:
+            key, _, value = line.decode('ascii', errors='replace').partition('=')
+            header[key.strip()] = value.strip()
+            if key.strip() == 'ElementDataFile':  # the last field
+                break
+    return header
+
+
+def read_image(filename: Union[str, Path], mmap: bool = True):
+    '''
+    Read mha/mhd image.
+    Uncompressed data is memory-mapped (read-only) instead of being loaded when `mmap` is True.
+    Header of memory-mapped image contains geometry fields only.
+
+    return: image and header
+    '''
+    from szkmipy import mhd
+
+    filename = Path(filename)
+    if not mmap or filename.suffix not in ['.mha', '.mhd']:
+        return mhd.read(str(filename))
+    h = read_mha_header(filename)
+    n_channels = int(h.get('ElementNumberOfChannels', 1))
+    if h.get('CompressedData', 'False') == 'True' or n_channels != 1 or h['ElementDataFile'] == 'LIST':
+        return mhd.read(str(filename))
+
+    shape = tuple(int(d) for d in reversed(h['DimSize'].split()))
+    msb = h.get('ElementByteOrderMSB', h.get('BinaryDataByteOrderMSB', 'False')) == 'True'
+    dtype = np.dtype(MET_TYPES[h['ElementType']]).newbyteorder('>' if msb else '<')
+    if h['ElementDataFile'] == 'LOCAL':
+        data_filename = filename
+        with open(filename, 'rb') as f:
+            for line in f:
+                if line.decode('ascii', errors='replace').startswith('ElementDataFile'):
+                    break
+            offset = f.tell()
+    else:
+        data_filename = filename.parent / h['ElementDataFile']
+        offset = int(h.get('HeaderSize', 0))
+        if offset == -1:  # data is at the end of the file
+            offset = data_filename.stat().st_size - int(np.prod(shape)) * dtype.itemsize
+    vol = np.memmap(data_filename, dtype=dtype, mode='r', offset=offset, shape=shape)
+    header = {key: [float(v) for v in h[key].split()] for key in GEOMETRY_FIELDS if key in h}
+    if 'AnatomicalOrientation' in h:
+        header['AnatomicalOrientation'] = h['AnatomicalOrientation']
+    return vol, header
+
+
+def estimate_image_bytes(filename: Union[str, Path]) -> int:
+    '''
+    Estimate in-memory size of image without loading it.
+    Dimensions x element size for mha/mhd and nifti, sum of uncompressed sizes for zip and file size for others.
+    '''
+    filename = Path(filename)
+    if filename.suffix in ['.mha', '.mhd']:
+        h = read_mha_header(filename)
+        n_elements = np.prod([int(d) for d in h['DimSize'].split()]) * int(h.get('ElementNumberOfChannels', 1))
+        return int(n_elements) * np.dtype(MET_TYPES[h['ElementType']]).itemsize
+    if filename.suffix == '.zip':
+        with zipfile.ZipFile(filename) as z:
+            return sum(info.file_size for info in z.infolist())
+    if filename.name.endswith(('.nii', '.nii.gz')):
+        import SimpleITK as sitk
+
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(str(filename))
+        reader.ReadImageInformation()
+        n_elements = np.prod(reader.GetSize()) * reader.GetNumberOfComponents()
+        return int(n_elements) * sitk.Image([1, 1, 1], reader.GetPixelID()).GetSizeOfPixelComponent()
+    return filename.stat().st_size
+
+
+def parse_size(size: str) -> int:
+    '''
+    Parse human readable size (e.g. `64G`, `512M`) into bytes.
+
+    >>> parse_size('1.5K')
+    1536
+    >>> parse_size('64G') == 64 * 2**30
+    True
+    '''
+    units = {'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+    size = size.strip().upper().rstrip('B')
+    if size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def physical_memory() -> Optional[int]:
+    '''
+    Physical memory in bytes. None if it's unavailable (e.g. windows).
+    '''
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def add_scheduler_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        '-j', '--jobs', help='Maximum number of parallel jobs. default: %(default)s', type=int, default=os.cpu_count()
+    )
+    parser.add_argument(
+        '--mem-budget',
+        help='Memory budget for parallel jobs (e.g. 48G). default: physical memory',
+        type=parse_size,
+        metavar='size',
+    )
+
+
+def run_parallel(
+    func: Callable,
+    tasks: Sequence[tuple],
+    mem_estimates: Sequence[int],
+    n_jobs: int,
+    mem_budget: Optional[int] = None,
+    on_done: Optional[Callable] = None,
+) -> List:
+    '''
+    Run `func(*task)` for each of `tasks` in a process pool.
+    Tasks are started in order as long as the sum of `mem_estimates` of running tasks fits in `mem_budget`.
+    A task exceeding the budget by itself is run alone.
+    `on_done(index, result)` is called in the main process as each task finishes.
+
+    return: results in the order of tasks
+    '''
+    from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+    from tqdm import tqdm
+
+    if mem_budget is None:
+        mem_budget = physical_memory()
+    results = [None] * len(tasks)
+    pending = list(range(len(tasks)))[::-1]  # pop from the end
+    running = {}
+    used = 0
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor, tqdm(total=len(tasks)) as pbar:
+        while pending or running:
+            while pending and len(running) < n_jobs:
+                i = pending[-1]
+                if running and mem_budget is not None and used + mem_estimates[i] > mem_budget:
+                    break
+                pending.pop()
+                running[executor.submit(func, *tasks[i])] = i
+                used += mem_estimates[i]
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = running.pop(future)
+                used -= mem_estimates[i]
+                results[i] = future.result()
+                if on_done is not None:
+                    on_done(i, results[i])
+                pbar.update()
+    return results
+
+
+def add_batch_arguments(parser: argparse.ArgumentParser):
+    '''
+    Add `--batch` and scheduler options for processing many files in one process.
+    '''
+    parser.add_argument(
+        '--batch',
+        help='Text file listing pairs of input and output filenames (tab separated, one pair per line)',
+        metavar='<filename>',
+    )
+    add_scheduler_arguments(parser)
+
+
+def read_batch(filename: Union[str, Path]) -> List[Tuple[str, str]]:
+    '''
+    Read pairs of input and output filenames. Pairs are separated by tab (or whitespace).
+    '''
+    pairs = []
+    with open(filename) as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if line.strip() == '':
+                continue
+            pair = line.split('\t') if '\t' in line else line.split()
+            if len(pair) != 2:
+                raise RuntimeError(f'Invalid line in {filename}: {line}')
+            pairs.append((pair[0], pair[1]))
+    return pairs
+
+
+def file_hash(filename: Union[str, Path]) -> str:
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
 def del_dirs(exec: bool, ds: list):
     if exec:
         print('Deleting directories...')
@@ -125,12 +608,16 @@ def main():
     sub_remove.add_argument('input', help='Input filename')
     sub_remove.add_argument('output', help='Output filename', nargs='?')
     sub_remove.add_argument('-m', '--mask', help='Save maks image', metavar='filename')
+    sub_remove.add_argument('--slab', help='Process in z-slabs of this many slices to save memory', type=int)
+    sub_remove.add_argument(
+        '-j', '--jobs', help='Number of threads for slabs. default: %(default)s', type=int, default=1
+    )
 
     def command_remove_bed(args):
         if args.output is None and args.mask is None:
             print('At least either one of --output or --mask needs to be specified.')
             sys.exit(1)
-        return remove_bed(args.input, args.output, args.mask)
+        return remove_bed(args.input, args.output, args.mask, args.slab, args.jobs)
 
     sub_remove.set_defaults(handler=command_remove_bed)
     args = parser.parse_args()
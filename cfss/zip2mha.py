@@ -1,12 +1,90 @@
 import argparse
+import io
+import json
 import shutil
 import subprocess
 import sys
+import time
+import zipfile
 from pathlib import Path
+from typing import Optional
 
-import tqdm
+import numpy as np
 from logzero import logger
-from utils import find_binary
+from utils import add_scheduler_arguments, estimate_image_bytes, file_hash, find_binary, run_parallel
+
+MEM_FACTOR = 3  # rough peak memory usage of dcm2itk relative to the uncompressed zip size
+MANIFEST_FILENAME = 'manifest.json'
+
+
+def read_zipped_dicom(filename: Path):
+    '''
+    Read the largest dicom series in the zip file into SimpleITK image without extracting files to disk.
+    Slices are decoded one by one into a preallocated volume.
+    '''
+    import pydicom
+    import SimpleITK as sitk
+
+    with zipfile.ZipFile(filename) as z:
+        series = {}
+        for info in z.infolist():
+            if info.is_dir():
+                continue
+            try:
+                ds = pydicom.dcmread(io.BytesIO(z.read(info)), stop_before_pixels=True)
+            except pydicom.errors.InvalidDicomError:
+                continue
+            if 'ImagePositionPatient' not in ds:
+                continue
+            series.setdefault(ds.SeriesInstanceUID, []).append((info, ds))
+        if len(series) == 0:
+            raise RuntimeError(f'No dicom image in {filename}')
+        slices = max(series.values(), key=len)
+        ds = slices[0][1]
+        row, col = np.array(ds.ImageOrientationPatient, dtype=float).reshape(2, 3)
+        normal = np.cross(row, col)
+        slices.sort(key=lambda s: np.dot(np.array(s[1].ImagePositionPatient, dtype=float), normal))
+        positions = np.array([s[1].ImagePositionPatient for s in slices], dtype=float)
+
+        vol = np.empty((len(slices), ds.Rows, ds.Columns), dtype=np.int16)
+        for i, (info, _) in enumerate(slices):
+            ds = pydicom.dcmread(io.BytesIO(z.read(info)))
+            slope = float(getattr(ds, 'RescaleSlope', 1))
+            intercept = float(getattr(ds, 'RescaleIntercept', 0))
+            vol[i] = np.round(ds.pixel_array * slope + intercept)
+
+    image = sitk.GetImageFromArray(vol)
+    z_spacing = np.median(np.diff(positions @ normal)) if len(slices) > 1 else float(ds.get('SliceThickness', 1))
+    image.SetSpacing((float(ds.PixelSpacing[1]), float(ds.PixelSpacing[0]), float(z_spacing)))
+    image.SetOrigin(positions[0].tolist())
+    image.SetDirection(np.stack([row, col, normal], axis=1).ravel().tolist())
+    return image
+
+
+def convert(zip_fn: str, out_fn: str, bin_path: Optional[str], retries: int) -> Optional[str]:
+    '''
+    Convert zipped dicom into mha. Use in-process reader if `bin_path` is None.
+
+    return: sha1 of the zip file or None if failed
+    '''
+    # write into temporary file so that interrupted conversion is not mistaken for complete one
+    tmp_fn = Path(out_fn).with_suffix('.part.mha')
+    for trial in range(retries + 1):
+        try:
+            if bin_path is None:
+                import SimpleITK as sitk
+
+                sitk.WriteImage(read_zipped_dicom(Path(zip_fn)), str(tmp_fn))
+            else:
+                subprocess.check_call([bin_path, zip_fn, str(tmp_fn)])
+            tmp_fn.replace(out_fn)
+            return file_hash(Path(zip_fn))
+        except Exception as e:
+            logger.warning('Failed (%d/%d) %s: %s', trial + 1, retries + 1, zip_fn, e)
+            time.sleep(trial)
+    logger.error('Give up: %s', zip_fn)
+    return None
+
 
 def main():
     parser = argparse.ArgumentParser(description='Convert (zipped) dicom into mha files')
@@ -16,6 +94,16 @@ def main():
         '--bin_dir',
         help='Directory containing binary executables'
     )
+    parser.add_argument(
+        '--reader',
+        help='dcm2itk binary or in-process reader (requires pydicom). default: %(default)s',
+        choices=['dcm2itk', 'pydicom'],
+        default='dcm2itk',
+    )
+    parser.add_argument(
+        '--retries', help='Number of retries for failed conversion. default: %(default)s', type=int, default=2
+    )
+    add_scheduler_arguments(parser)
 
 
     args = parser.parse_args()
@@ -28,29 +116,48 @@ def main():
     else:
         bin_dir = '/bin'
 
-    BIN = find_binary(bin_dir, 'dcm2itk')
+    BIN = None if args.reader == 'pydicom' else str(find_binary(bin_dir, 'dcm2itk'))
 
 
     root = Path(args.indir)
     outdir = Path(args.outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+
+    # output (relative to outdir) -> {zip, sha1, size, mtime}
+    manifest_fn = outdir / MANIFEST_FILENAME
+    manifest = json.loads(manifest_fn.read_text()) if manifest_fn.exists() else {}
+
+    def is_done(zip_fn: Path, out_fn: Path):
+        if not out_fn.exists():
+            return False
+        entry = manifest.get(out_fn.relative_to(outdir).as_posix())
+        if entry is None:  # converted before the manifest was introduced
+            return True
+        stat = zip_fn.stat()
+        if entry['size'] != stat.st_size:
+            return False
+        if entry['mtime'] == stat.st_mtime:
+            return True
+        return entry['sha1'] == file_hash(zip_fn)
+
     dirs = sorted([fn for fn in root.glob('*') if fn.is_dir()])
     logger.debug(dirs)
+    # one queue for all hospitals
+    all_args = []
+    mems = []
     for indir in dirs:
         hosp_name = indir.name
-        (outdir / indir.name).mkdir(parents=True, exist_ok=True)
-        all_args = []
         logger.info(str(indir))
         for pid_dir in sorted(indir.glob('*')):
             pid = pid_dir.name
             for i, fn in enumerate(sorted(pid_dir.glob('*.zip'))):
                 (outdir / hosp_name / pid).mkdir(parents=True, exist_ok=True)
                 outfn = outdir / hosp_name / pid / '{}.mha'.format(i + 1)
-                if outfn.exists():
+                if is_done(fn, outfn):
                     logger.info('Skip: %s', fn)
                     continue
-                args = [BIN, fn, outfn]
-                args = [str(e) for e in args]
-                all_args.append(args)
+                all_args.append((str(fn), str(outfn), BIN, args.retries))
+                mems.append(MEM_FACTOR * estimate_image_bytes(fn))
                 src = fn.with_suffix('.json')
                 dst = outfn.with_suffix('.json')
                 try:
@@ -58,11 +165,28 @@ def main():
                 except Exception as e:
                     print(e)
                 # print(args)
-        from joblib import Parallel, delayed
 
-        Parallel(n_jobs=7)(delayed(subprocess.check_call)(arg) for arg in tqdm.tqdm(all_args))
-        # break
-        # subprocess.check_call(args)
+    def on_done(index, sha1):
+        if sha1 is None:
+            return
+        zip_fn, out_fn = Path(all_args[index][0]), Path(all_args[index][1])
+        stat = zip_fn.stat()
+        manifest[out_fn.relative_to(outdir).as_posix()] = {
+            'zip': str(zip_fn),
+            'sha1': sha1,
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+        }
+        tmp_fn = manifest_fn.with_suffix('.tmp')
+        tmp_fn.write_text(json.dumps(manifest, indent=2))
+        tmp_fn.replace(manifest_fn)
+
+    logger.info('%d files to convert', len(all_args))
+    results = run_parallel(convert, all_args, mems, args.jobs, args.mem_budget, on_done)
+    n_failed = sum(r is None for r in results)
+    if n_failed > 0:
+        logger.error('%d files failed', n_failed)
+        return 1
 
 
 if __name__ == '__main__':
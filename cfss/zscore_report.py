@@ -0,0 +1,91 @@
+import argparse
+import csv
+import sys
+from pathlib import Path
+from typing import List, Tuple
+
+import landmark
+import numpy as np
+from logzero import logger
+from ssm import PCAStats, read_model_index
+from utils import read_batch
+
+
+def pair_stats(pca_stats: PCAStats, point_pairs: List[Tuple[int, int]], n_jobs: int = 1):
+    '''
+    `PCAStats.distance_stats` split into chunks of pairs computed in parallel (threads)
+    return: distances and z-scores (n_samples x n_pairs)
+    '''
+    from joblib import Parallel, delayed
+
+    # reconstruct all the points at once. chunks only read the cache
+    pca_stats.get_points_batch(np.unique(point_pairs))
+    chunks = np.array_split(np.asarray(point_pairs), max(1, min(n_jobs, len(point_pairs))))
+    results = Parallel(n_jobs=n_jobs, prefer='threads')(delayed(pca_stats.distance_stats)(chunk) for chunk in chunks)
+    dists = np.concatenate([r.dists for r in results], axis=1)
+    z = np.concatenate([r.z for r in results], axis=1)
+    return dists, z
+
+
+def write_report(filename: Path, ids: List[str], label_pairs: List[Tuple[str, str]], dists, z):
+    '''
+    Write long format table (id, landmark1, landmark2, distance, z_score) in csv or parquet
+    '''
+    columns = ['id', 'landmark1', 'landmark2', 'distance', 'z_score']
+    rows = [
+        (data_id, l1, l2, float(dists[i, k]), float(z[i, k]))
+        for k, (l1, l2) in enumerate(label_pairs)
+        for i, data_id in enumerate(ids)
+    ]
+    if filename.suffix == '.parquet':
+        try:
+            import pandas as pd
+        except ImportError:
+            logger.error('pandas (and pyarrow) is required to write parquet')
+            raise
+        pd.DataFrame(rows, columns=columns).to_parquet(filename, index=False)
+    else:
+        with open(filename, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            writer.writerows(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Distances and z-scores between landmark pairs for all subjects.')
+    parser.add_argument('landmarks', help='Landmark filename (.mrk.json) on the mean shape')
+    parser.add_argument('model', help='PCA model (.npz) created by `ssm.py build_model`')
+    parser.add_argument('output', help='Output filename (.csv or .parquet)')
+    parser.add_argument('--pairs', help='File of landmark label pairs separated by tab (or whitespace), one per line')
+    parser.add_argument(
+        '--pair', help='Landmark label pair', nargs=2, action='append', default=[], metavar=('LABEL1', 'LABEL2')
+    )
+    parser.add_argument('-j', '--jobs', help='Number of threads. default: %(default)s', type=int, default=1)
+    args = parser.parse_args()
+
+    label_pairs = [tuple(pair) for pair in args.pair]
+    if args.pairs:
+        label_pairs += read_batch(args.pairs)
+    if len(label_pairs) == 0:
+        parser.error('Specify landmark pairs with --pairs or --pair')
+
+    landmarks = landmark.to_dict(landmark.load_landmarks(args.landmarks))
+    unknown = sorted({label for pair in label_pairs for label in pair}.difference(landmarks))
+    if len(unknown) > 0:
+        logger.error('Unknown landmarks: %s', ', '.join(unknown))
+        return 1
+
+    pca_stats, mesh = PCAStats.from_model(args.model)
+    ids = read_model_index(args.model)['ids']
+    labels = sorted({label for pair in label_pairs for label in pair})
+    point_ids = dict(zip(labels, landmark.locate_landmarks(mesh, [landmarks[label] for label in labels])))
+    point_pairs = [(point_ids[l1], point_ids[l2]) for l1, l2 in label_pairs]
+
+    dists, z = pair_stats(pca_stats, point_pairs, args.jobs)
+    write_report(Path(args.output), ids, label_pairs, dists, z)
+    logger.info('Wrote %d pairs x %d subjects into %s', len(label_pairs), len(ids), args.output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -24,6 +24,9 @@ FINAL_MESH_EXT = os.environ.get('FINAL_MESH_EXT', '.vtp')  # file extension for
 N_MESH_POINTS = int(os.environ.get('N_MESH_POINTS', '80000'))
 
 REF_ID = os.environ.get('REF_ID', '')  # optional
+BATCH_SIZE = int(os.environ.get('BATCH_SIZE', '32'))  # number of IDs processed in one process
+# `append`: register only new IDs against the frozen template and add them to the existing model without refitting
+UPDATE_MODE = os.environ.get('UPDATE_MODE', 'full')
 
 with open(ID_LIST_FILENAME) as f:
     id_list = [l.rstrip() for l in f.readlines()]
@@ -48,6 +51,39 @@ def task_ids():
     return {'actions': [f"echo '\n'.join(id_list)"]}
 
 
+def batches(pairs: list):
+    for i in range(0, len(pairs), BATCH_SIZE):
+        yield i // BATCH_SIZE, pairs[i : i + BATCH_SIZE]
+
+
+def batch_action(script, pairs, options=''):
+    '''
+    Create python-action to process pairs of input and output in one process.
+    Only pairs with missing output or changed input (newer than output) are processed.
+    '''
+
+    def is_outdated(infn, outfn, changed):
+        if not Path(outfn).exists():
+            return True
+        # doit reports all file_dep as changed when any target is missing. check timestamps as well.
+        return str(infn) in changed and Path(infn).stat().st_mtime > Path(outfn).stat().st_mtime
+
+    def action(changed):
+        import subprocess
+
+        changed = set(changed)
+        todo = [(i, o) for i, o in pairs if is_outdated(i, o, changed)]
+        if len(todo) == 0:
+            return
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            batch_fn = Path(tmpdirname) / 'batch.txt'
+            with open(batch_fn, 'w') as f:
+                f.writelines(f'{i}\t{o}\n' for i, o in todo)
+            subprocess.check_call(f'python {script} --batch {batch_fn} {options}', shell=True)
+
+    return action
+
+
 LEVELSET_OUTDIR = OUT_DIR / 'fast_marching'
 
 
@@ -57,19 +93,19 @@ def task_levelset():
     '''
     script = SRC_DIR / 'fast_marching.py'
     LEVELSET_OUTDIR.mkdir(exist_ok=True, parents=True)
-    for data_id in id_list:
-        infn = SEG_DIR / f'{data_id}.nii.gz'
-        outfn = LEVELSET_OUTDIR / f'{data_id}.mha'
+    pairs = [(SEG_DIR / f'{data_id}.nii.gz', LEVELSET_OUTDIR / f'{data_id}.mha') for data_id in id_list]
+    for i, batch in batches(pairs):
         yield {
-            'name': data_id,
-            'actions': [f'python {script} {infn} {outfn}'],
-            'file_dep': [infn],
-            'targets': [outfn],
+            'name': f'batch{i}',
+            'actions': [batch_action(script, batch)],
+            'file_dep': [infn for infn, _ in batch],
+            'targets': [outfn for _, outfn in batch],
             'clean': True,
         }
 
 
 MESH_OUTDIR = OUT_DIR / 'mesh'
+MESH_CACHE_DIR = OUT_DIR / 'mesh_cache'
 FINE_MESH_OUTDIR = OUT_DIR / 'mesh_fine'
 
 
@@ -80,14 +116,14 @@ def task_mesh():
     script = SRC_DIR / 'create_mesh.py'
     MESH_OUTDIR.mkdir(parents=True, exist_ok=True)
 
-    for data_id in id_list:
-        infn = LEVELSET_OUTDIR / f'{data_id}.mha'
-        outfn = MESH_OUTDIR / f'{data_id}{MESH_EXT}'
+    pairs = [(LEVELSET_OUTDIR / f'{data_id}.mha', MESH_OUTDIR / f'{data_id}{MESH_EXT}') for data_id in id_list]
+    options = f'--points {N_MESH_POINTS} --cache_dir {MESH_CACHE_DIR} --warm_start'
+    for i, batch in batches(pairs):
         yield {
-            'name': f'{data_id}',
-            'actions': [f'python {script} {infn} {outfn} --points {N_MESH_POINTS}'],
-            'file_dep': [infn],
-            'targets': [outfn],
+            'name': f'batch{i}',
+            'actions': [batch_action(script, batch, options)],
+            'file_dep': [infn for infn, _ in batch],
+            'targets': [outfn for _, outfn in batch],
             'clean': True,
         }
 
@@ -174,6 +210,25 @@ def task_register():
     FINAL_TOLERANCE = 0.0001  # Value for espilon
     REG_OUTDIR.mkdir(exist_ok=True, parents=True)
     ref_fn = (ALIGN_OUTDIR / f'{REF_ID}{MESH_EXT}').absolute()
+    if UPDATE_MODE == 'append':
+        # template of the last iteration is kept as is
+        if N_REG_ITER > 1:
+            ref_fn = REG_OUTDIR / f'iter{N_REG_ITER - 2}' / 'average_surface.vtk'
+        for data_id in id_list:
+            output = REG_OUTDIR / f'{data_id}{MESH_EXT}'
+            if output.exists():
+                continue
+            logdir = REG_OUTDIR / 'log' / data_id
+            logdir.mkdir(parents=True, exist_ok=True)
+            mesh = ALIGN_OUTDIR / f'{data_id}{MESH_EXT}'
+            args = (BIN_DIR, ref_fn, mesh, output, logdir, FINAL_TOLERANCE, N_ITER, FINAL_DS)
+            yield {
+                'name': f'{data_id}-append',
+                'actions': [(irtk_reg.register, args)],
+                'file_dep': [ref_fn, mesh],  # runs align_bb (mesh, levelset) for the new ID
+                'targets': [output],
+            }
+        return
     file_dep = []  # TODO: file_dep[bb alignemnt]
     for i in range(N_REG_ITER):
         if i == (N_REG_ITER - 1):
@@ -233,14 +288,68 @@ def task_presets():
     return {'actions': [f'python {script} {lmfn} {PRESET_FILENAME}'], 'targets': [PRESET_FILENAME], 'file_dep': [lmfn]}
 
 
+SHAPE_MATRIX_FILENAME = OUT_DIR / 'shapes.npy'
+
+
+def task_shape_matrix():
+    '''
+    Stack aligned meshes into one memory-mappable matrix for the browser
+    '''
+    script = SRC_DIR / 'ssm.py'
+    meshes = [ALIGN_LM_OUTDIR / f'{data_id}{FINAL_MESH_EXT}' for data_id in id_list]
+    return {
+        'actions': [f'python {script} build_matrix {ALIGN_LM_OUTDIR} {SHAPE_MATRIX_FILENAME}'],
+        'file_dep': meshes,
+        'targets': [SHAPE_MATRIX_FILENAME],
+        'clean': True,
+    }
+
+
+MODEL_FILENAME = OUT_DIR / 'ssm_model.npz'
+
+
+def task_model():
+    '''
+    Fit PCA model for the browser
+    '''
+    script = SRC_DIR / 'ssm.py'
+    options = f'--matrix {SHAPE_MATRIX_FILENAME}'
+    if UPDATE_MODE == 'append':
+        options += ' --append'
+    return {
+        'actions': [f'python {script} build_model {ALIGN_LM_OUTDIR} {MODEL_FILENAME} {options}'],
+        'file_dep': [SHAPE_MATRIX_FILENAME],
+        'targets': [MODEL_FILENAME],
+        'clean': True,
+    }
+
+
+LANDMARK_PAIRS_FILENAME = Path(os.environ.get('LANDMARK_PAIRS_FILENAME', 'data/landmark_pairs.txt'))
+REPORT_FILENAME = OUT_DIR / 'zscores.csv'
+
+
+def task_report():
+    '''
+    Write distances and z-scores between landmark pairs (LANDMARK_PAIRS_FILENAME) for all subjects
+    '''
+    script = SRC_DIR / 'zscore_report.py'
+    lmfn = LANDMARK_DIR / f'{REF_ID}.mrk.json'
+    return {
+        'actions': [f'python {script} {lmfn} {MODEL_FILENAME} {REPORT_FILENAME} --pairs {LANDMARK_PAIRS_FILENAME}'],
+        'file_dep': [lmfn, MODEL_FILENAME, LANDMARK_PAIRS_FILENAME],
+        'targets': [REPORT_FILENAME],
+        'clean': True,
+    }
+
+
 def task_browse():
     '''
     Open cfdb browser
     '''
     script = SRC_DIR / 'shape_stats.py'
     return {
-        'actions': [f'python {script} -i {ALIGN_LM_OUTDIR} --cameras {PRESET_FILENAME}'],
-        'file_dep': [PRESET_FILENAME],
+        'actions': [f'python {script} -i {ALIGN_LM_OUTDIR} --cameras {PRESET_FILENAME} --model {MODEL_FILENAME}'],
+        'file_dep': [PRESET_FILENAME, MODEL_FILENAME],
         'uptodate': [False],
     }
 
@@ -248,7 +357,7 @@ def task_browse():
 LAUNCH_BAT = r'''set bin=%~dp0shape_stats\shape_stats.exe
 set data_dir=%~dp0result
 
-%bin% -i %data_dir%\lm_aligned --camera %data_dir%\camera_presets.json
+%bin% -i %data_dir%\lm_aligned --camera %data_dir%\camera_presets.json --model %data_dir%\ssm_model.npz
 pause
 '''
 
@@ -281,6 +390,8 @@ def task_package():
             shutil.move(tmpdir / 'dist' / 'shape_stats', bindir)
             logger.info('copy camera data')
             shutil.copy(PRESET_FILENAME, datadir)
+            logger.info('copy model')
+            shutil.copy(MODEL_FILENAME, datadir)
             logger.info('copy mesh data')
             shutil.copytree(ALIGN_LM_OUTDIR, datadir / ALIGN_LM_OUTDIR.name)
             logger.info('write bat')
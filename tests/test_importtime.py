@@ -0,0 +1,36 @@
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+
+SRC_DIR = Path(__file__).resolve().parent.parent / 'cfss'
+IMPORT_TIME_BUDGET = 0.5  # seconds
+HEAVY_MODULES = ['vtkmodules', 'scipy', 'SimpleITK', 'cc3d', 'sklearn', 'pyvista']
+
+
+def import_times(module: str) -> dict:
+    '''
+    Cumulative import time (seconds) of each module imported by `import module` (`python -X importtime`)
+    '''
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=SRC_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    # "import time: self [us] | cumulative | name"
+    for line in proc.stderr.splitlines()[1:]:
+        _, cumulative, name = line.split('|')
+        times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+@pytest.mark.parametrize('module', ['utils', 'landmark'])
+def test_light_module_import(module):
+    times = import_times(module)
+    assert times[module] <= IMPORT_TIME_BUDGET
+    assert not [name for name in HEAVY_MODULES if name in times]
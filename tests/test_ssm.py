@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+from sklearn.decomposition import PCA
+from ssm import PCAStats
+
+
+N_MODES = 8  # compared components. later ones are noise with nearly equal variances.
+
+
+def shapes(n_samples: int, n_features: int = 1500, seed: int = 0) -> np.ndarray:
+    '''
+    Random data with well separated variances of the leading modes
+    '''
+    rng = np.random.default_rng(seed)
+    basis = np.linalg.qr(rng.normal(size=(n_features, N_MODES)))[0].T
+    scales = 10.0 ** np.linspace(2, 0.5, N_MODES)
+    X = (rng.normal(size=(n_samples, N_MODES)) * scales) @ basis + rng.normal(scale=0.1, size=(n_samples, n_features))
+    return X + rng.normal(size=n_features)
+
+
+def assert_same_model(stats: PCAStats, ref: PCAStats):
+    np.testing.assert_allclose(stats.mean, ref.mean, atol=1e-10)
+    np.testing.assert_allclose(stats.explained_variance[:N_MODES], ref.explained_variance[:N_MODES], rtol=1e-8)
+    # signs included
+    np.testing.assert_allclose(stats.components[:N_MODES], ref.components[:N_MODES], atol=1e-8)
+    np.testing.assert_allclose(stats.all_coefs[:, :N_MODES], ref.all_coefs[:, :N_MODES], atol=1e-6)
+
+
+@pytest.mark.parametrize('n_components', [None, N_MODES])
+def test_gram_matches_full_pca(n_components):
+    X = shapes(40)
+    stats = PCAStats.fit(X, n_components, svd_solver='gram')
+    pca = PCA(n_components=n_components, svd_solver='full')
+    ref = PCAStats._from_pca(pca, pca.fit_transform(X))
+    assert_same_model(stats, ref)
+    assert len(stats.components) == (len(X) - 1 if n_components is None else n_components)
+
+
+def test_auto_uses_gram():
+    X = shapes(40)
+    np.testing.assert_array_equal(PCAStats.fit(X).components, PCAStats.fit(X, svd_solver='gram').components)
+
+
+def test_update_matches_refit():
+    X = shapes(40)
+    stats = PCAStats.fit(X[:30], svd_solver='gram').update(X[30:])
+    assert_same_model(stats, PCAStats.fit(X, svd_solver='full'))
+
+
+def test_update_truncated():
+    X = shapes(40)
+    n_components = N_MODES - 3
+    stats = PCAStats.fit(X[:30], n_components, svd_solver='gram').update(X[30:])
+    ref = PCAStats.fit(X, n_components, svd_solver='full')
+    assert stats.components.shape == ref.components.shape
+    assert stats.all_coefs.shape == ref.all_coefs.shape
+    # approximate: variance outside of the kept components is lost
+    np.testing.assert_allclose(stats.mean, ref.mean, atol=1e-10)
+    np.testing.assert_allclose(stats.explained_variance, ref.explained_variance, rtol=1e-2)
+    np.testing.assert_allclose(stats.components, ref.components, atol=1e-2)